@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import os
+import sys
+import json
+import time
+import multiprocessing
+import kociemba
+from validator import validate, get_faces_to_rescan, get_message, is_solved
+from constants import BATCH_CHUNK_SIZE
+
+
+def solve_state(task):
+    """
+    Solve a single state in a worker process.
+
+    :param task tuple: The (index, state) to solve.
+    :returns: dict
+    """
+    index, state = task
+    result = {
+        'index': index,
+        'state': state,
+        'solution': None,
+        'moves': None,
+        'time_ms': None,
+        'error': None,
+        'faces': None,
+    }
+    start = time.perf_counter()
+    try:
+        errors = validate(state)
+        if errors:
+            result['faces'] = get_faces_to_rescan(errors)
+            raise ValueError('Invalid state: {}'.format(get_message(errors)))
+        if is_solved(state):
+            raise ValueError('The cube is already solved.')
+        algorithm = kociemba.solve(state)
+        result['solution'] = algorithm
+        result['moves'] = len(algorithm.split(' '))
+    except ValueError as e:
+        result['error'] = str(e)
+    result['time_ms'] = (time.perf_counter() - start) * 1000
+    return result
+
+
+class Batch:
+
+    def __init__(self, workers=None, ordered=True, normalize=False):
+        """
+        :param ordered bool: Print the results in the order of the input,
+                             otherwise as soon as they are solved.
+        :param normalize bool: Also add the human-readable solution.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.ordered = ordered
+        self.normalize = normalize
+
+    def read_states(self, f):
+        """
+        Read one state per line, skipping empty lines and # comments.
+
+        Yields (index, state) tuples.
+        """
+        index = 0
+        for line in f:
+            state = line.strip()
+            if not state or state.startswith('#'):
+                continue
+            yield index, state
+            index += 1
+
+    def normalize_solution(self, algorithm):
+        """Get the human-readable text of every move of a solution."""
+        import i18n
+        return [i18n.t('solveManual.{}'.format(notation)) for notation in algorithm.split(' ')]
+
+    def solve(self, f):
+        """
+        Solve all the states of the given file object across multiple
+        processes.
+
+        Yields a result for every state.
+        """
+        with multiprocessing.Pool(self.workers) as pool:
+            imap = pool.imap if self.ordered else pool.imap_unordered
+            for result in imap(solve_state, self.read_states(f), BATCH_CHUNK_SIZE):
+                if self.normalize and result['solution']:
+                    result['normalized'] = self.normalize_solution(result['solution'])
+                yield result
+
+    def run(self, path):
+        """Solve all the states in the given file, or stdin for '-'."""
+        f = sys.stdin if path == '-' else open(path, 'r')
+        try:
+            for result in self.solve(f):
+                sys.stdout.write(json.dumps(result, ensure_ascii=False) + '\n')
+                sys.stdout.flush()
+        finally:
+            if f is not sys.stdin:
+                f.close()
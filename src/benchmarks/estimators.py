@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+Micro-benchmark of the dominant color estimators.
+
+Run it from the src directory:
+
+    $ python -m benchmarks.estimators
+"""
+
+import argparse
+import time
+import numpy as np
+from colordetection import color_detector
+from cubedetection import cube_detector
+from benchmarks.synthetic import random_face, render_face
+from benchmarks.vision import use_temporary_config
+
+
+def create_rois(rng, sticker_size=45):
+    """
+    Render a noisy cube face and crop its nine sticker ROIs like the
+    detector does.
+
+    :returns: list of 9 np.ndarray BGR ROIs, or None when the face wasn't
+              detected
+    """
+    frame = render_face(rng, random_face(rng), sticker_size=sticker_size)
+    contours = cube_detector.detect(frame)
+    if len(contours) != 9:
+        return None
+
+    # Add the noise after detecting, so every face is found.
+    frame = np.clip(frame + rng.normal(0, 12, frame.shape), 0, 255).astype(np.uint8)
+    return cube_detector.get_sticker_rois(frame, contours)
+
+
+def run(frames, sticker_size):
+    """Time every estimator and print the average cost per frame."""
+    rng = np.random.default_rng(0)
+    rois = []
+    while len(rois) < frames:
+        frame_rois = create_rois(rng, sticker_size)
+        if frame_rois is not None:
+            rois.append(frame_rois)
+    default_estimator = color_detector.dominant_color_estimator
+
+    print('{:<14} {:>12}'.format('estimator', 'ms/frame'))
+    for name in color_detector.dominant_color_estimators.keys():
+        color_detector.dominant_color_estimator = name
+        start = time.perf_counter()
+        for frame_rois in rois:
+            color_detector.get_dominant_colors(frame_rois)
+        elapsed = (time.perf_counter() - start) / frames
+        print('{:<14} {:>12.3f}'.format(name, elapsed * 1000))
+
+    color_detector.dominant_color_estimator = default_estimator
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=200, help='Amount of frames to time.')
+    parser.add_argument('--sticker-size', type=int, default=45, help='Sticker width in pixels.')
+    args = parser.parse_args()
+
+    config_dir = use_temporary_config()
+    run(args.frames, args.sticker_size)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+Render synthetic webcam frames of a 3x3x3 cube face with known facelets.
+"""
+
+import numpy as np
+import cv2
+from validator import (
+    CORNER_FACELETS,
+    EDGE_FACELETS,
+    CORNER_COLORS,
+    EDGE_COLORS,
+    get_permutation_parity
+)
+
+# Realistic sticker colors (BGR) as seen by a webcam, the classifier should map
+# these onto the palette.
+STICKER_COLORS = {
+    'red'   : (40, 30, 190),
+    'orange': (30, 120, 240),
+    'blue'  : (150, 70, 0),
+    'green' : (60, 160, 0),
+    'white' : (220, 220, 220),
+    'yellow': (30, 210, 220),
+}
+
+NOTATION_COLORS = {
+    'U': 'white',
+    'R': 'red',
+    'F': 'green',
+    'D': 'yellow',
+    'L': 'orange',
+    'B': 'blue',
+}
+
+def random_state(rng):
+    """
+    Create a random solvable cube state.
+
+    :returns: str of 54 facelets in URFDLB order
+    """
+    cp = list(rng.permutation(8))
+    ep = list(rng.permutation(12))
+    if get_permutation_parity(cp) != get_permutation_parity(ep):
+        ep[0], ep[1] = ep[1], ep[0]
+
+    co = list(rng.integers(0, 3, 7))
+    co.append(-sum(co) % 3)
+    eo = list(rng.integers(0, 2, 11))
+    eo.append(sum(eo) % 2)
+
+    facelets = ['U'] * 54
+    for center, notation in zip(range(4, 54, 9), 'URFDLB'):
+        facelets[center] = notation
+    for i in range(8):
+        for n in range(3):
+            facelets[CORNER_FACELETS[i][(n + co[i]) % 3]] = CORNER_COLORS[cp[i]][n]
+    for i in range(12):
+        for n in range(2):
+            facelets[EDGE_FACELETS[i][(n + eo[i]) % 2]] = EDGE_COLORS[ep[i]][n]
+    return ''.join(facelets)
+
+def random_face(rng):
+    """Create 9 random sticker color names."""
+    names = list(STICKER_COLORS.keys())
+    return [names[i] for i in rng.integers(0, len(names), 9)]
+
+def draw_clutter(rng, frame, amount, avoid):
+    """Draw random shapes onto the frame, outside of the avoid rectangle."""
+    height, width = frame.shape[:2]
+    (ax1, ay1, ax2, ay2) = avoid
+    for _ in range(amount):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        if ax1 <= x <= ax2 and ay1 <= y <= ay2:
+            continue
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        size = int(rng.integers(5, 60))
+        shape = rng.integers(0, 3)
+        if shape == 0:
+            cv2.rectangle(frame, (x, y), (x + size, y + size), color, -1)
+        elif shape == 1:
+            cv2.circle(frame, (x, y), size // 2, color, 2)
+        else:
+            cv2.line(frame, (x, y), (x + size, y + int(rng.integers(-size, size))), color, 2)
+
+def render_face(rng, face, width=640, height=480, sticker_size=45, rotation=0.0,
+                noise=0.0, blur=0, lighting=1.0, clutter=0):
+    """
+    Render a single cube face onto a synthetic frame.
+
+    :param face list: 9 color names, row by row from the top-left.
+    :param sticker_size int: Sticker width in pixels.
+    :param rotation float: Rotation of the face in degrees.
+    :param noise float: Standard deviation of the gaussian pixel noise.
+    :param blur int: Gaussian blur kernel size, 0 to disable.
+    :param lighting float: Brightness gain, combined with a horizontal gradient.
+    :param clutter int: Amount of random background shapes.
+    :returns: np.ndarray BGR frame
+    """
+    background = rng.integers(30, 120, 3)
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[:] = background
+
+    gap = max(2, sticker_size // 6)
+    face_size = sticker_size * 3 + gap * 4
+    margin = face_size // 2 + 10
+    cx = int(rng.integers(margin, width - margin))
+    cy = int(rng.integers(margin, height - margin))
+
+    half = face_size / 2 + 5
+    draw_clutter(rng, frame, clutter, (cx - half, cy - half, cx + half, cy + half))
+
+    rotation_matrix = cv2.getRotationMatrix2D((cx, cy), rotation, 1.0)
+
+    def fill_square(x1, y1, size, color):
+        corners = np.array([[x1, y1, 1], [x1 + size, y1, 1], [x1 + size, y1 + size, 1], [x1, y1 + size, 1]])
+        points = (corners @ rotation_matrix.T).round().astype(np.int32)
+        cv2.fillPoly(frame, [points], color)
+
+    # The black cube body and the stickers on top of it.
+    fill_square(cx - face_size / 2, cy - face_size / 2, face_size, (10, 10, 10))
+    for index, color_name in enumerate(face):
+        row, col = divmod(index, 3)
+        x1 = cx - face_size / 2 + gap + (sticker_size + gap) * col
+        y1 = cy - face_size / 2 + gap + (sticker_size + gap) * row
+        jitter = rng.integers(-10, 11, 3)
+        color = tuple(int(c) for c in np.clip(np.array(STICKER_COLORS[color_name]) + jitter, 0, 255))
+        fill_square(x1, y1, sticker_size, color)
+
+    gradient = np.linspace(0.85, 1.15, width)[None, :, None]
+    image = frame.astype(np.float32) * lighting * gradient
+    if noise > 0:
+        image += rng.normal(0, noise, image.shape)
+    frame = np.clip(image, 0, 255).astype(np.uint8)
+    if blur > 0:
+        ksize = blur if blur % 2 == 1 else blur + 1
+        frame = cv2.GaussianBlur(frame, (ksize, ksize), 0)
+    return frame
+
+def random_scene(rng, width=640, height=480):
+    """
+    Render a random face with random variations.
+
+    :returns: tuple of the frame and the 9 ground-truth color names
+    """
+    face = random_face(rng)
+    frame = render_face(
+        rng,
+        face,
+        width=width,
+        height=height,
+        sticker_size=int(rng.integers(36, 56) * width / 640),
+        rotation=float(rng.uniform(-8, 8)),
+        noise=float(rng.uniform(0, 8)),
+        blur=int(rng.choice([0, 0, 3, 5])),
+        lighting=float(rng.uniform(0.7, 1.2)),
+        clutter=int(rng.integers(0, 30)),
+    )
+    return frame, face
+
+
+class SyntheticCamera:
+    """A camera that reads random scenes, like a cv2.VideoCapture."""
+
+    def __init__(self, rng, width=640, height=480):
+        self.rng = rng
+        self.width = width
+        self.height = height
+
+    def read(self):
+        frame, _ = random_scene(self.rng, self.width, self.height)
+        return True, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        return 0
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        pass
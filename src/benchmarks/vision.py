@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+Benchmark the vision hot path on synthetic frames, without a camera.
+
+Run it from the src directory:
+
+    $ python -m benchmarks.vision --output before.json
+    $ python -m benchmarks.vision --compare before.json
+"""
+
+import argparse
+import json
+import sys
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import kociemba
+from colordetection import color_detector
+from cubedetection import cube_detector
+from config import Config, config
+from video import Webcam
+from benchmarks.synthetic import (
+    SyntheticCamera,
+    NOTATION_COLORS,
+    STICKER_COLORS,
+    random_scene,
+    random_state,
+    render_face
+)
+
+# Detecting the cube may allocate at most this fraction of a frame per frame,
+# once its buffers are allocated. Copying a frame on every call fails this.
+MAX_ALLOCATED_FRAME_FRACTION = 0.05
+
+
+def get_version():
+    """Get the git version of the code that is being benchmarked."""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            stderr=subprocess.DEVNULL
+        ).decode('utf-8').strip()
+    except Exception:
+        return None
+
+def summarize(timings):
+    """Get the mean, p50, p99 and max of a list of timings in milliseconds."""
+    timings = np.array(timings) * 1000
+    if len(timings) == 0:
+        return None
+    return {
+        'count': int(len(timings)),
+        'mean_ms': float(timings.mean()),
+        'p50_ms': float(np.percentile(timings, 50)),
+        'p99_ms': float(np.percentile(timings, 99)),
+        'max_ms': float(timings.max()),
+    }
+
+
+def use_temporary_config():
+    """
+    Use a config in a temporary directory, so the benchmark never touches the
+    palette, lookup tables or solution cache of the user. It has to be called
+    before anything uses the config.
+
+    :returns: tempfile.TemporaryDirectory, which is removed once it's gone
+    """
+    directory = tempfile.TemporaryDirectory(prefix='qbr-benchmark-')
+    config.set_instance(Config(directory.name))
+    return directory
+
+
+class VisionBenchmark:
+
+    def __init__(self, seed=0, width=640, height=480):
+        self.rng = np.random.default_rng(seed)
+        self.width = width
+        self.height = height
+        self.config_dir = use_temporary_config()
+        self.webcam = Webcam(SyntheticCamera(np.random.default_rng(seed), width, height))
+
+        # Time the solver itself, not the solution cache or a solve that was
+        # already started in the background.
+        self.webcam.solve_in_background = False
+
+        # Drawing the interface needs the font, which isn't always available.
+        try:
+            self.webcam.get_font()
+            self.render = True
+        except OSError:
+            self.render = False
+
+    def reset_webcam(self):
+        """Reset the state of the webcam in between runs."""
+        self.webcam.width = self.width
+        self.webcam.height = self.height
+        self.webcam.calibrate_mode = False
+        self.webcam.sticker_filter.reset()
+        self.webcam.result_state = {}
+        self.webcam.result_samples = {}
+
+    def time_stage(self, timings, name, function, *args):
+        """Run a function and record how long it took under the given name."""
+        start = time.perf_counter()
+        result = function(*args)
+        timings.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+
+    def run_frames(self, frames):
+        """
+        Time every stage of the webcam loop on random scenes.
+
+        :returns: dict
+        """
+        self.reset_webcam()
+        scenes = [random_scene(self.rng, self.width, self.height) for _ in range(frames)]
+        color_names = dict(zip(color_detector.palette_bgr, color_detector.palette_names))
+        timings = {}
+        detected = 0
+        correct = 0
+        start = time.perf_counter()
+        for frame, face in scenes:
+            # Scenes are unrelated, so don't let the preview vote over them.
+            self.webcam.sticker_filter.reset()
+            frame_start = time.perf_counter()
+            self.webcam.frame = frame.copy()
+            small, scale, size_scale = self.time_stage(timings, 'downscale', cube_detector.downscale, self.webcam.frame)
+            dilated = self.time_stage(timings, 'preprocess', cube_detector.preprocess, small, size_scale)
+            contours = self.time_stage(timings, 'find_contours', cube_detector.find_contours, dilated, size_scale)
+            contours = [(x * scale, y * scale, w * scale, h * scale) for (x, y, w, h) in contours]
+            if len(contours) == 9:
+                detected += 1
+                self.time_stage(timings, 'update_preview_state', self.webcam.update_preview_state, contours)
+                correct += sum(
+                    color_names.get(bgr) == color_name
+                    for bgr, color_name in zip(self.webcam.preview_state, face)
+                )
+            if self.render:
+                self.time_stage(timings, 'draw_interface', self.webcam.draw_interface)
+            timings.setdefault('frame', []).append(time.perf_counter() - frame_start)
+        elapsed = time.perf_counter() - start
+
+        return {
+            'frames': frames,
+            'throughput_fps': frames / elapsed,
+            'detection_rate': detected / frames,
+            'accuracy': correct / (detected * 9) if detected else 0.0,
+            'stages': {name: summarize(values) for name, values in timings.items()},
+        }
+
+    def run_allocations(self, frames):
+        """
+        Measure the peak memory that detecting the cube allocates per frame.
+        The buffers are allocated on the first frame, so after that it should
+        stay flat and below MAX_ALLOCATED_FRAME_FRACTION of a single frame.
+
+        :returns: dict, with passed set to False when a frame allocated more
+        """
+        scenes = [random_scene(self.rng, self.width, self.height) for _ in range(frames)]
+        cube_detector.detect(scenes[0][0])
+        allocations = []
+        tracemalloc.start()
+        try:
+            for frame, _ in scenes:
+                tracemalloc.reset_peak()
+                current, _ = tracemalloc.get_traced_memory()
+                cube_detector.detect(frame)
+                allocations.append(tracemalloc.get_traced_memory()[1] - current)
+        finally:
+            tracemalloc.stop()
+
+        allocations = np.array(allocations)
+        frame_bytes = self.width * self.height * 3
+        return {
+            'frames': frames,
+            'frame_bytes': frame_bytes,
+            'mean_bytes': float(allocations.mean()),
+            'max_bytes': int(allocations.max()),
+            'limit_bytes': int(frame_bytes * MAX_ALLOCATED_FRAME_FRACTION),
+            'passed': bool(allocations.max() <= frame_bytes * MAX_ALLOCATED_FRAME_FRACTION),
+        }
+
+    def run_scans(self, cubes):
+        """
+        Time the full path from six scanned faces to a solution.
+
+        :returns: dict
+        """
+        timings = {}
+        solved = 0
+        for _ in range(cubes):
+            self.reset_webcam()
+            state = random_state(self.rng)
+            scan_start = time.perf_counter()
+            for offset in range(0, 54, 9):
+                face = [NOTATION_COLORS[notation] for notation in state[offset:offset + 9]]
+                self.webcam.frame = render_face(self.rng, face, self.width, self.height, int(45 * self.width / 640))
+                contours = cube_detector.detect(self.webcam.frame)
+                if len(contours) == 9:
+                    self.webcam.sticker_filter.reset()
+                    self.webcam.update_preview_state(contours)
+                    self.webcam.update_snapshot_state()
+
+            if len(self.webcam.result_state.keys()) == 6:
+                notation = self.time_stage(timings, 'get_result_notation', self.webcam.get_result_notation)
+                if notation == state:
+                    self.time_stage(timings, 'solve', kociemba.solve, notation)
+                    solved += 1
+            timings.setdefault('scan_to_solution', []).append(time.perf_counter() - scan_start)
+
+        return {
+            'cubes': cubes,
+            'accuracy': solved / cubes if cubes else 0.0,
+            'stages': {name: summarize(values) for name, values in timings.items()},
+        }
+
+    def run(self, frames, cubes):
+        """
+        Run the whole benchmark with a palette calibrated on the synthetic
+        sticker colors, like a user would after using calibrate mode.
+        """
+        color_detector.set_cube_color_pallete(STICKER_COLORS)
+        return {
+            'version': get_version(),
+            'width': self.width,
+            'height': self.height,
+            'frames': self.run_frames(frames),
+            'allocations': self.run_allocations(min(frames, 50)),
+            'scans': self.run_scans(cubes),
+        }
+
+
+def print_report(report, baseline=None):
+    """Print the stage timings, and their change compared to a baseline."""
+    print('version: {}'.format(report['version']))
+    allocations = report.get('allocations')
+    if allocations:
+        print('\n[allocations] {:.0f} bytes per frame on average, {} at most, a frame is {} bytes'.format(
+            allocations['mean_bytes'], allocations['max_bytes'], allocations['frame_bytes']))
+        print('{}, the limit is {} bytes'.format(
+            'passed' if allocations['passed'] else 'FAILED', allocations['limit_bytes']))
+    for section in ['frames', 'scans']:
+        results = report[section]
+        print('\n[{}] accuracy {:.3f}'.format(section, results['accuracy']))
+        if 'throughput_fps' in results:
+            print('throughput {:.1f} fps, detection rate {:.3f}'.format(
+                results['throughput_fps'], results['detection_rate']))
+        print('{:<22} {:>10} {:>10} {:>10}'.format('stage', 'p50 ms', 'p99 ms', 'change'))
+        for name, stats in results['stages'].items():
+            if stats is None:
+                continue
+            change = ''
+            base = baseline and baseline[section]['stages'].get(name)
+            if base:
+                change = '{:+.1f}%'.format((stats['p50_ms'] / base['p50_ms'] - 1) * 100)
+            print('{:<22} {:>10.3f} {:>10.3f} {:>10}'.format(name, stats['p50_ms'], stats['p99_ms'], change))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=300, help='Amount of synthetic frames to time.')
+    parser.add_argument('--cubes', type=int, default=20, help='Amount of cubes to scan and solve.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic scenes.')
+    parser.add_argument('--width', type=int, default=640, help='Width of the synthetic frames.')
+    parser.add_argument('--height', type=int, default=480, help='Height of the synthetic frames.')
+    parser.add_argument('--output', help='Write the results as JSON to this file.')
+    parser.add_argument('--compare', help='A JSON file of an earlier run to compare against.')
+    args = parser.parse_args()
+
+    report = VisionBenchmark(args.seed, args.width, args.height).run(args.frames, args.cubes)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if not report['allocations']['passed']:
+        sys.exit(1)
@@ -2,11 +2,27 @@
 # -*- coding: utf-8 -*-
 # vim: fenc=utf-8 ts=4 sw=4 et
 
+import os
+import glob
+import json
+import hashlib
+import tempfile
 import numpy as np
 import cv2
-from helpers import ciede2000, bgr2lab
+from helpers import bgr2lab_batch, ciede2000_batch, linear_sum_assignment
 from config import config
-from constants import CUBE_PALETTE, COLOR_PLACEHOLDER
+from lazy import Lazy
+from constants import (
+    CUBE_PALETTE,
+    COLOR_MODELS,
+    COLOR_MODEL_COVARIANCE_EPSILON,
+    COLOR_PLACEHOLDER,
+    DOMINANT_COLOR_ESTIMATOR,
+    DEFAULT_DOMINANT_COLOR_ESTIMATOR,
+    PALETTE_LUT_BINS,
+    PALETTE_LUT_FILENAME,
+    PALETTE_LUT_KEEP
+)
 
 class ColorDetection:
 
@@ -20,6 +36,15 @@ class ColorDetection:
             'yellow': (0, 255, 255)
         }
 
+        self.notations = {
+            'green' : 'F',
+            'white' : 'U',
+            'blue'  : 'B',
+            'red'   : 'R',
+            'orange': 'L',
+            'yellow': 'D'
+        }
+
         # Load colors from config and convert the list -> tuple.
         self.cube_color_palette = config.get_setting(
             CUBE_PALETTE,
@@ -28,12 +53,256 @@ class ColorDetection:
         for side, bgr in self.cube_color_palette.items():
             self.cube_color_palette[side] = tuple(bgr)
 
+        # Gaussian color models in LAB from a calibration, when available
+        # these are used to classify colors instead of CIEDE2000.
+        self.color_models = config.get_setting(COLOR_MODELS)
+        self.update_palette_lab()
+
+        # All estimators take the pixels of all ROIs concatenated together,
+        # plus the amount of pixels per ROI, and return one color per ROI.
+        self.dominant_color_estimators = {
+            'kmeans'      : self.get_kmeans_colors,
+            'mean'        : self.get_mean_colors,
+            'median'      : self.get_median_colors,
+            'trimmed_mean': self.get_trimmed_mean_colors,
+            'histogram'   : self.get_histogram_colors,
+        }
+        self.dominant_color_estimator = config.get_setting(
+            DOMINANT_COLOR_ESTIMATOR,
+            DEFAULT_DOMINANT_COLOR_ESTIMATOR
+        )
+        if self.dominant_color_estimator not in self.dominant_color_estimators:
+            self.dominant_color_estimator = DEFAULT_DOMINANT_COLOR_ESTIMATOR
+
+    def update_palette_lab(self):
+        """
+        Convert the cube color palette to LAB once, so it doesn't have to be
+        converted again for every sticker that is being classified.
+        """
+        self.palette_names = list(self.cube_color_palette.keys())
+        self.palette_bgr = list(self.cube_color_palette.values())
+        self.palette_lab = bgr2lab_batch(self.palette_bgr)
+        self.prominent_colors = {}
+        for color_name, bgr in self.cube_color_palette.items():
+            self.prominent_colors.setdefault(bgr, self.prominent_color_palette[color_name])
+        self.update_color_models()
+        self.update_palette_lut()
+
+    def fit_color_models(self, samples):
+        """
+        Fit a gaussian in LAB to the calibration samples of every color.
+
+        :param samples dict: Color name -> array-like of shape (N, 3) with BGR
+                             samples of that color.
+        :returns: dict of color name -> {'mean': [...], 'covariance': [[...]]}
+        """
+        models = {}
+        for color_name, bgrs in samples.items():
+            lab = bgr2lab_batch(bgrs)
+            covariance = np.cov(lab, rowvar=False) if len(lab) > 1 else np.zeros((3, 3))
+            covariance = covariance + np.eye(3) * COLOR_MODEL_COVARIANCE_EPSILON
+            models[color_name] = {
+                'mean': lab.mean(axis=0).tolist(),
+                'covariance': covariance.tolist(),
+            }
+        return models
+
+    def update_color_models(self):
+        """
+        Prepare the inverse covariances and log determinants of the color
+        models in palette order, or disable them when they don't cover the
+        whole palette.
+        """
+        if not self.color_models or any(name not in self.color_models for name in self.palette_names):
+            self.color_models = None
+            return
+        covariances = np.array([self.color_models[name]['covariance'] for name in self.palette_names])
+        self.model_means = np.array([self.color_models[name]['mean'] for name in self.palette_names])
+        self.model_inv_covariances = np.linalg.inv(covariances)
+        self.model_log_dets = np.linalg.slogdet(covariances)[1]
+
+    def get_palette_lut_path(self):
+        """Get the lookup table path, keyed by a hash of the current palette."""
+        key = json.dumps([self.palette_names, self.palette_bgr, self.color_models, PALETTE_LUT_BINS])
+        palette_hash = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(config.config_dir, PALETTE_LUT_FILENAME.format(palette_hash))
+
+    def build_palette_lut(self):
+        """
+        Classify the center of every quantized BGR bin against the palette.
+
+        :returns: np.ndarray of shape (bins, bins, bins) with palette indices
+        """
+        step = 256 // PALETTE_LUT_BINS
+        centers = np.arange(PALETTE_LUT_BINS) * step + (step - 1) / 2
+        grid = np.stack(np.meshgrid(centers, centers, centers, indexing='ij'), axis=-1)
+        grid = grid.reshape(-1, 3)
+
+        # Work in chunks to keep the memory usage of the CIEDE2000
+        # intermediates low.
+        lut = np.empty(len(grid), dtype=np.uint8)
+        chunk_size = 32768
+        for start in range(0, len(grid), chunk_size):
+            scores, _ = self.get_color_scores(grid[start:start + chunk_size])
+            lut[start:start + chunk_size] = np.argmin(scores, axis=1)
+        return lut.reshape(PALETTE_LUT_BINS, PALETTE_LUT_BINS, PALETTE_LUT_BINS)
+
+    def update_palette_lut(self):
+        """
+        Load the lookup table for the current palette from the config dir, or
+        build and save it when it doesn't exist yet. The table is memory-mapped
+        so a previously calibrated palette loads instantly.
+
+        Several processes can build the same table at the same time, so every
+        process writes its own temporary file. When the table can't be saved
+        or loaded, it's only kept in memory.
+
+        Processes that start workers load the table before starting them. With
+        the fork start method the workers inherit it, with spawn (the default
+        on macOS and Windows) they memory-map the saved table. Only when it
+        couldn't be saved, spawned workers build it again.
+        """
+        lut_path = self.get_palette_lut_path()
+        if not os.path.exists(lut_path):
+            lut = self.build_palette_lut()
+            try:
+                fd, tmp_path = tempfile.mkstemp(dir=config.config_dir, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        np.save(f, lut)
+                    os.replace(tmp_path, lut_path)
+                except OSError:
+                    os.remove(tmp_path)
+                    raise
+            except OSError:
+                self.palette_lut = lut
+                return
+            self.remove_old_palette_luts()
+
+        try:
+            self.palette_lut = np.load(lut_path, mmap_mode='r')
+            os.utime(lut_path)
+        except (OSError, ValueError):
+            self.palette_lut = self.build_palette_lut()
+
+    def remove_old_palette_luts(self):
+        """
+        Remove all but the PALETTE_LUT_KEEP most recently used lookup tables.
+        Loading a table marks it as used, so the tables of palettes that other
+        processes still use are kept.
+        """
+        pattern = os.path.join(config.config_dir, PALETTE_LUT_FILENAME.format('*'))
+        lut_paths = []
+        for lut_path in glob.glob(pattern):
+            try:
+                lut_paths.append((os.path.getmtime(lut_path), lut_path))
+            except FileNotFoundError:
+                pass
+
+        for _, lut_path in sorted(lut_paths, reverse=True)[PALETTE_LUT_KEEP:]:
+            try:
+                os.remove(lut_path)
+            except FileNotFoundError:
+                pass
+
+    def get_palette_indices(self, bgrs):
+        """
+        Classify many BGR colors with the lookup table.
+
+        This is an approximation of get_closest_colors which only differs for
+        colors close to the decision boundary between two palette colors.
+
+        :param bgrs: array-like of shape (N, 3) with BGR colors.
+        :returns: np.ndarray of shape (N,) with indices into self.palette_names
+        """
+        bgrs = np.clip(np.asarray(bgrs).reshape(-1, 3), 0, 255).astype(np.int64)
+        bins = bgrs * PALETTE_LUT_BINS // 256
+        return self.palette_lut[bins[:, 0], bins[:, 1], bins[:, 2]]
+
     def get_prominent_color(self, bgr):
         """Get the prominent color equivalent of the given bgr color."""
-        for color_name, color_bgr in self.cube_color_palette.items():
-            if tuple([int(c) for c in bgr]) == color_bgr:
-                return self.prominent_color_palette[color_name]
-        return COLOR_PLACEHOLDER
+        return self.prominent_colors.get(tuple([int(c) for c in bgr]), COLOR_PLACEHOLDER)
+
+    def get_kmeans_colors(self, pixels, sizes):
+        """Run k-means with a single cluster on every ROI separately."""
+        colors = []
+        offsets = np.cumsum(sizes)[:-1]
+        n_colors = 1
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 200, .1)
+        flags = cv2.KMEANS_RANDOM_CENTERS
+        for roi_pixels in np.split(np.float32(pixels), offsets):
+            _, labels, palette = cv2.kmeans(roi_pixels, n_colors, None, criteria, 10, flags)
+            _, counts = np.unique(labels, return_counts=True)
+            colors.append(palette[np.argmax(counts)])
+        return np.array(colors)
+
+    def get_mean_colors(self, pixels, sizes):
+        """Get the mean color of every ROI."""
+        starts = np.cumsum(sizes) - sizes
+        sums = np.add.reduceat(pixels.astype(np.float64), starts, axis=0)
+        return sums / sizes[:, None]
+
+    def get_sorted_channels(self, pixels, sizes):
+        """Sort every channel of every ROI separately."""
+        groups = np.repeat(np.arange(len(sizes)), sizes)[:, None] * 256
+        return np.sort(pixels.astype(np.int64) + groups, axis=0) - groups
+
+    def get_median_colors(self, pixels, sizes):
+        """Get the channel-wise median color of every ROI."""
+        starts = np.cumsum(sizes) - sizes
+        channels = self.get_sorted_channels(pixels, sizes)
+        low = channels[starts + (sizes - 1) // 2]
+        high = channels[starts + sizes // 2]
+        return (low + high) / 2
+
+    def get_trimmed_mean_colors(self, pixels, sizes, proportion=0.1):
+        """
+        Get the channel-wise mean color of every ROI, ignoring the lowest and
+        highest proportion of the values, such as specular highlights.
+        """
+        starts = np.cumsum(sizes) - sizes
+        channels = self.get_sorted_channels(pixels, sizes)
+        cumsum = np.concatenate([np.zeros((1, 3)), np.cumsum(channels, axis=0)])
+        cut = (sizes * proportion).astype(np.int64)
+        low = starts + cut
+        high = starts + sizes - cut
+        return (cumsum[high] - cumsum[low]) / (high - low)[:, None]
+
+    def get_histogram_colors(self, pixels, sizes, bins=8):
+        """
+        Get the mode color of every ROI using a coarse 3D histogram with the
+        given amount of bins per channel. The mean of the pixels in the most
+        common bin is returned, rather than the center of that bin.
+        """
+        n_rois = len(sizes)
+        groups = np.repeat(np.arange(n_rois), sizes)
+        quantized = pixels.astype(np.int64) * bins // 256
+        bin_index = (quantized[:, 0] * bins + quantized[:, 1]) * bins + quantized[:, 2]
+        counts = np.bincount(groups * bins**3 + bin_index, minlength=n_rois * bins**3)
+        modes = np.argmax(counts.reshape(n_rois, -1), axis=1)
+
+        in_mode = bin_index == modes[groups]
+        mode_groups = groups[in_mode]
+        mode_sizes = np.bincount(mode_groups, minlength=n_rois)
+        colors = np.empty((n_rois, 3))
+        for channel in range(3):
+            sums = np.bincount(mode_groups, weights=pixels[in_mode, channel], minlength=n_rois)
+            colors[:, channel] = sums / mode_sizes
+        return colors
+
+    def get_dominant_colors(self, rois):
+        """
+        Get the dominant color of many regions of interest at once, using the
+        configured estimator.
+
+        :param rois: A list of images.
+        :returns: list of tuples
+        """
+        pixels = [roi.reshape(-1, 3) for roi in rois]
+        sizes = np.array([len(roi_pixels) for roi_pixels in pixels])
+        estimator = self.dominant_color_estimators[self.dominant_color_estimator]
+        colors = estimator(np.concatenate(pixels), sizes)
+        return [tuple(float(c) for c in bgr) for bgr in colors]
 
     def get_dominant_color(self, roi):
         """
@@ -42,33 +311,117 @@ class ColorDetection:
         :param roi: The image list.
         :returns: tuple
         """
-        pixels = np.float32(roi.reshape(-1, 3))
+        return self.get_dominant_colors([roi])[0]
 
-        n_colors = 1
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 200, .1)
-        flags = cv2.KMEANS_RANDOM_CENTERS
-        _, labels, palette = cv2.kmeans(pixels, n_colors, None, criteria, 10, flags)
-        _, counts = np.unique(labels, return_counts=True)
-        dominant = palette[np.argmax(counts)]
-        return tuple(dominant)
+    def get_color_distances(self, bgrs):
+        """
+        Get the CIEDE2000 distances of many BGR colors against the palette.
+
+        :param bgrs: array-like of shape (N, 3) with BGR colors.
+        :returns: np.ndarray of shape (N, 6), columns follow self.palette_names
+        """
+        return ciede2000_batch(bgr2lab_batch(bgrs), self.palette_lab)
+
+    def get_mahalanobis_distances(self, bgrs):
+        """
+        Get the squared Mahalanobis distances of many BGR colors against the
+        color models.
+
+        :param bgrs: array-like of shape (N, 3) with BGR colors.
+        :returns: np.ndarray of shape (N, 6), columns follow self.palette_names
+        """
+        diff = bgr2lab_batch(bgrs)[:, None, :] - self.model_means[None, :, :]
+        return np.einsum('nki,kij,nkj->nk', diff, self.model_inv_covariances, diff)
+
+    def get_color_scores(self, bgrs):
+        """
+        Get the scores to classify many BGR colors with, the lowest score wins.
+
+        With color models these are the quadratic discriminant scores, which
+        take the spread of every color into account, otherwise the CIEDE2000
+        distances.
+
+        :param bgrs: array-like of shape (N, 3) with BGR colors.
+        :returns: tuple of the (N, 6) scores and (N, 6) distances, the
+                  distances are Mahalanobis distances with color models and
+                  CIEDE2000 distances otherwise
+        """
+        if self.color_models is None:
+            distances = self.get_color_distances(bgrs)
+            return distances, distances
+        squared_distances = self.get_mahalanobis_distances(bgrs)
+        return squared_distances + self.model_log_dets, np.sqrt(squared_distances)
+
+    def get_closest_colors(self, bgrs):
+        """
+        Get the closest palette color for many BGR colors at once.
+
+        Without color models, the distances equal the ones from
+        helpers.ciede2000 within 1e-9, so the result is the same as calling
+        get_closest_color for each color, except for exact ties.
+
+        :param bgrs: array-like of shape (N, 3) with BGR colors.
+        :returns: list of dicts
+        """
+        scores, distances = self.get_color_scores(bgrs)
+        closest = []
+        for index, row in zip(np.argmin(scores, axis=1), distances):
+            closest.append({
+                'color_name': self.palette_names[index],
+                'color_bgr': self.palette_bgr[index],
+                'distance': float(row[index])
+            })
+        return closest
 
     def get_closest_color(self, bgr):
         """
-        Get the closest color of a BGR color using CIEDE2000 distance.
+        Get the closest color of a BGR color using the color models, or the
+        CIEDE2000 distance without them.
 
         :param bgr tuple: The BGR color to use.
         :returns: dict
         """
-        lab = bgr2lab(bgr)
-        distances = []
-        for color_name, color_bgr in self.cube_color_palette.items():
-            distances.append({
-                'color_name': color_name,
-                'color_bgr': color_bgr,
-                'distance': ciede2000(lab, bgr2lab(color_bgr))
-            })
-        closest = min(distances, key=lambda item: item['distance'])
-        return closest
+        return self.get_closest_colors([bgr])[0]
+
+    def assign_balanced_colors(self, bgrs, center_indices):
+        """
+        Classify all stickers of a cube together, so that every color is used
+        equally often, by solving a balanced assignment.
+
+        The cost of a sticker for a color is its CIEDE2000 distance to the
+        center sticker of that color as it was scanned, so the assignment is
+        anchored on the centers and unaffected by the lighting of the
+        calibration. The centers themselves always keep their own color.
+
+        :param bgrs: array-like of shape (N, 3) with the raw BGR colors of all
+                     stickers, N must be a multiple of the amount of colors.
+        :param center_indices list: The index of the center sticker of every
+                                    color.
+        :returns: np.ndarray of shape (N,) with the color of every sticker as
+                  an index into center_indices
+        """
+        bgrs = np.asarray(bgrs, dtype=np.float64)
+        lab = bgr2lab_batch(bgrs)
+        n_colors = len(center_indices)
+        costs = ciede2000_batch(lab, lab[center_indices])
+
+        # Pin every center to its own color.
+        pinned = costs.max() * len(bgrs) + 1
+        costs[center_indices, :] = pinned
+        costs[center_indices, np.arange(n_colors)] = 0
+
+        # Every color gets as many slots as it has stickers.
+        slots = np.repeat(costs, len(bgrs) // n_colors, axis=1)
+        return linear_sum_assignment(slots) // (len(bgrs) // n_colors)
+
+    def convert_bgrs_to_notation(self, bgrs):
+        """
+        Convert many BGR tuples to rubik's cube notation in one go.
+
+        :param bgrs: array-like of shape (N, 3) with BGR colors.
+        :returns: list of str
+        """
+        return [self.notations[item['color_name']] for item in self.get_closest_colors(bgrs)]
 
     def convert_bgr_to_notation(self, bgr):
         """
@@ -78,24 +431,21 @@ class ColorDetection:
         :param bgr tuple: The BGR values to convert.
         :returns: str
         """
-        notations = {
-            'green' : 'F',
-            'white' : 'U',
-            'blue'  : 'B',
-            'red'   : 'R',
-            'orange': 'L',
-            'yellow': 'D'
-        }
-        color_name = self.get_closest_color(bgr)['color_name']
-        return notations[color_name]
+        return self.convert_bgrs_to_notation([bgr])[0]
 
-    def set_cube_color_pallete(self, palette):
+    def set_cube_color_pallete(self, palette, color_models=None):
         """
         Set a new cube color palette. The palette is being used when the user is
         scanning his cube in solve mode by matching the scanned colors against
         this palette.
+
+        :param color_models dict: The gaussian models of the palette colors,
+                                  see fit_color_models. Without them colors
+                                  are matched using CIEDE2000.
         """
         for side, bgr in palette.items():
             self.cube_color_palette[side] = tuple([int(c) for c in bgr])
+        self.color_models = color_models
+        self.update_palette_lab()
 
-color_detector = ColorDetection()
+color_detector = Lazy(ColorDetection)
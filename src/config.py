@@ -5,12 +5,17 @@
 import os
 import json
 import platform
+from lazy import Lazy
 
 
 class Config:
 
-    def __init__(self):
-        self.config_dir = os.path.join(self.get_basedir, '.config/qbr')
+    def __init__(self, config_dir=None):
+        """
+        :param config_dir str: The directory to keep the settings in, instead
+                               of the config dir of the user.
+        """
+        self.config_dir = config_dir or os.path.join(self.get_basedir, '.config/qbr')
         self.settings_file = os.path.join(self.config_dir, 'settings.json')
 
         try:
@@ -39,8 +44,12 @@ class Config:
     def set_setting(self, key, value):
         """Set a specific setting and save it."""
         self.settings[key] = value
+        self.save()
+
+    def save(self):
+        """Save all settings."""
         with open(self.settings_file, 'w') as f:
             json.dump(self.settings, f)
             f.close()
 
-config = Config()
+config = Lazy(Config)
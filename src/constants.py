@@ -36,9 +36,109 @@ STICKER_CONTOUR_COLOR = (36, 255, 12)
 CALIBRATE_MODE_KEY = 'c'
 SWITCH_LANGUAGE_KEY = 'l'
 TEXT_SIZE = 18
+TEXT_SPRITE_CACHE_SIZE = 128
+FONT_PATH = os.path.join(ROOT_DIR, 'assets', 'arial-unicode-ms.ttf')
+WINDOW_TITLE = "Qbr - Rubik's cube solver"
+
+# Cube detection, the sticker sizes are in pixels of a DETECTION_WIDTH wide frame.
+CAPTURE_WIDTH = 640
+CAPTURE_HEIGHT = 480
+DETECTION_WIDTH = 640
+DILATION_KERNEL_SIZE = 9
+STICKER_MIN_WIDTH = 30
+STICKER_MAX_WIDTH = 60
+
+# The part of a sticker to ignore on each side when sampling its color,
+# relative to the sticker size.
+STICKER_ROI_INSET_X = 0.3
+STICKER_ROI_INSET_Y = 0.15
+
+# The Canny thresholds at a median brightness of CANNY_REFERENCE_MEDIAN, which
+# is about what a webcam gives in a normally lit room. They are scaled along
+# with the square root of the median brightness of every frame within the
+# given bounds, so dim and bright scenes still get their edges.
+CANNY_THRESHOLDS = (30, 60)
+CANNY_REFERENCE_MEDIAN = 128
+CANNY_MIN_SCALE = 0.15
+CANNY_MAX_SCALE = 2.0
+
+# Only detect again when more than MOTION_THRESHOLD of the pixels of a
+# MOTION_WIDTH wide grayscale frame changed by more than MOTION_PIXEL_THRESHOLD
+# since the last detection.
+MOTION_WIDTH = 80
+MOTION_PIXEL_THRESHOLD = 16
+MOTION_THRESHOLD = 0.01
+
+# Solver
+WARM_UP_STATE = 'DRLUUBFBRBLURRLRUBLRDDFDLFUFUFFDBRDUBRUFLLFDDBFLUBLRBD'
+SOLUTION_CACHE_FILENAME = 'solutions.json'
+SOLUTION_CACHE_SIZE = 1000
+
+# Headless scanning
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+# Multi-camera scanning, a camera stops after this many failed reads in a row.
+# Failed reads are retried after PIPELINE_READ_RETRY_DELAY.
+STATION_MAX_READ_FAILURES = 100
+
+# Batch solving, the amount of states to send to a worker at once.
+BATCH_CHUNK_SIZE = 4
+
+# Serve mode
+SERVER_SOCKET_FILENAME = 'qbr.sock'
+
+# Pipeline mode
+PIPELINE_QUEUE_SIZE = 1
+
+# When a read from the camera fails, wait this many seconds before trying
+# again. The pipeline stops after this many failed reads in a row, for example
+# at the end of a video.
+PIPELINE_READ_RETRY_DELAY = 0.01
+PIPELINE_MAX_READ_FAILURES = 100
+
+# Session recording, frames are stored as PNG with this compression level
+# (0-9), which is lossless so a replay sees exactly the same pixels. Frames are
+# compressed on a thread of their own, with at most this many waiting.
+SESSION_VERSION = 1
+SESSION_PNG_COMPRESSION = 1
+SESSION_QUEUE_SIZE = 30
+
+# Profiling
+PROFILER_HUD_KEY = 'p'
+PROFILER_HUD_COLOR = (36, 255, 12)
+PROFILER_WINDOW = 120
 
 # Config
 CUBE_PALETTE = 'cube_palette'
+DOMINANT_COLOR_ESTIMATOR = 'dominant_color_estimator'
+COLOR_MODELS = 'color_models'
+
+# Color detection
+DEFAULT_DOMINANT_COLOR_ESTIMATOR = 'mean'
+PALETTE_LUT_BINS = 64
+PALETTE_LUT_FILENAME = 'palette_lut_{}.npy'
+
+# The lookup tables of this many of the most recently used palettes are kept,
+# so processes that run at the same time with different palettes don't keep
+# removing each other's tables.
+PALETTE_LUT_KEEP = 4
+
+# Calibration collects samples of all stickers over this amount of frames. Only
+# stickers within this CIEDE2000 distance of the center sticker are used, so
+# the cube doesn't need to be solved.
+CALIBRATION_FRAMES = 15
+CALIBRATION_MAX_DISTANCE = 15
+# Added to the diagonal of every color model covariance, in LAB units squared,
+# so a color with very little spread doesn't get a singular covariance.
+COLOR_MODEL_COVARIANCE_EPSILON = 1.0
+
+# The amount of frames to take a majority vote over for the preview stickers.
+STICKER_FILTER_SIZE = 8
+
+# Auto-capture snapshots a face once every sticker has had the same color with
+# at least this confidence for this amount of frames in a row.
+AUTO_CAPTURE_FRAMES = 10
+AUTO_CAPTURE_CONFIDENCE = 0.75
 
 # Application errors
 E_INCORRECTLY_SCANNED = 1
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import math
+import threading
+import numpy as np
+import cv2
+from profiler import profiler
+from constants import (
+    CANNY_THRESHOLDS,
+    CANNY_REFERENCE_MEDIAN,
+    CANNY_MIN_SCALE,
+    CANNY_MAX_SCALE,
+    DETECTION_WIDTH,
+    DILATION_KERNEL_SIZE,
+    MOTION_WIDTH,
+    MOTION_PIXEL_THRESHOLD,
+    MOTION_THRESHOLD,
+    STICKER_MIN_WIDTH,
+    STICKER_MAX_WIDTH,
+    STICKER_ROI_INSET_X,
+    STICKER_ROI_INSET_Y
+)
+
+
+class Preprocessor:
+    """
+    The edge detection chain of a single thread. Every step writes into a
+    buffer that is only allocated again when the frames get larger, so
+    processing a frame doesn't allocate any images.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get_buffer(self, name, shape):
+        """
+        Get a uint8 buffer of the given shape, as a view into a buffer that is
+        at least that large.
+        """
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape[0] < shape[0] or buffer.shape[1] < shape[1]:
+            if buffer is not None:
+                shape_to_allocate = (max(buffer.shape[0], shape[0]), max(buffer.shape[1], shape[1])) + shape[2:]
+            else:
+                shape_to_allocate = shape
+            buffer = np.empty(shape_to_allocate, dtype=np.uint8)
+            self.buffers[name] = buffer
+        return buffer[:shape[0], :shape[1]]
+
+    def pyr_down(self, frame, level):
+        """Downscale a frame by 2 into the buffer of the given pyramid level."""
+        height, width = frame.shape[:2]
+        shape = ((height + 1) // 2, (width + 1) // 2) + frame.shape[2:]
+        return cv2.pyrDown(frame, dst=self.get_buffer('pyramid_{}'.format(level), shape))
+
+    def get_canny_thresholds(self, grayFrame):
+        """
+        Scale the Canny thresholds along with the median brightness of the
+        frame, so the sticker edges are still found in dim light and the
+        noise isn't in bright light. The noise of a camera doesn't drop as
+        fast as the brightness, so the thresholds follow its square root.
+
+        :returns: tuple of the lower and upper threshold
+        """
+        # Every 4th pixel of every 4th row is plenty to estimate the median.
+        histogram = cv2.calcHist([grayFrame[::4, ::4]], [0], None, [256], [0, 256]).cumsum()
+        median = np.searchsorted(histogram, histogram[-1] / 2)
+        scale = min(CANNY_MAX_SCALE, max(CANNY_MIN_SCALE, math.sqrt(median / CANNY_REFERENCE_MEDIAN)))
+        return CANNY_THRESHOLDS[0] * scale, CANNY_THRESHOLDS[1] * scale
+
+    def preprocess(self, frame, kernel):
+        """
+        Turn a BGR frame into a dilated edge image.
+
+        :returns: np.ndarray view into a buffer, which is overwritten by the
+                  next frame
+        """
+        shape = frame.shape[:2]
+        grayFrame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.get_buffer('gray', shape))
+        blurredFrame = cv2.blur(grayFrame, (3, 3), dst=self.get_buffer('blurred', shape))
+        lower, upper = self.get_canny_thresholds(blurredFrame)
+        cannyFrame = cv2.Canny(blurredFrame, lower, upper, edges=self.get_buffer('canny', shape), apertureSize=3)
+        return cv2.dilate(cannyFrame, kernel, dst=self.get_buffer('dilated', shape))
+
+
+class CubeDetection:
+
+    def __init__(self):
+        self.kernels = {}
+
+        # Every thread gets its own buffers, since the pipeline and the
+        # server detect on several threads.
+        self.local = threading.local()
+
+    def get_preprocessor(self):
+        """Get the preprocessor of the current thread."""
+        if not hasattr(self.local, 'preprocessor'):
+            self.local.preprocessor = Preprocessor()
+        return self.local.preprocessor
+
+    def get_kernel(self, size_scale):
+        """Get the dilation kernel, scaled along with the sticker sizes."""
+        size = round(DILATION_KERNEL_SIZE * size_scale)
+        if size % 2 == 0:
+            size += 1
+        if size not in self.kernels:
+            self.kernels[size] = cv2.getStructuringElement(cv2.MORPH_RECT, (size, size))
+        return self.kernels[size]
+
+    def preprocess(self, frame, size_scale=1.0):
+        """
+        Turn a BGR frame into a dilated edge image.
+
+        :returns: np.ndarray which is overwritten by the next frame that is
+                  preprocessed on the same thread
+        """
+        return self.get_preprocessor().preprocess(frame, self.get_kernel(size_scale))
+
+    def get_pyramid_level(self, frame_width):
+        """
+        Get the amount of times a frame has to be downscaled by 2, so its width
+        is closest to DETECTION_WIDTH. The sticker sizes grow with the
+        resolution, so this keeps them around the same size in pixels.
+        """
+        return max(0, round(math.log2(frame_width / DETECTION_WIDTH)))
+
+    def downscale(self, frame, frame_width=None):
+        """
+        Downscale a frame to its detection pyramid level.
+
+        :param frame_width int: The width of the whole frame, when the given
+                                frame is only a part of it.
+        :returns: tuple of the downscaled frame, the scale to map coordinates
+                  back to the full resolution and the scale of the sticker
+                  size limits
+        """
+        frame_width = frame_width or frame.shape[1]
+        level = self.get_pyramid_level(frame_width)
+        preprocessor = self.get_preprocessor()
+        for index in range(level):
+            frame = preprocessor.pyr_down(frame, index)
+
+        scale = 2 ** level
+        return frame, scale, frame_width / scale / DETECTION_WIDTH
+
+    def detect(self, frame, frame_width=None):
+        """
+        Find the contours of a cube in the given BGR frame.
+
+        Detection runs on a downscaled pyramid level of the frame and the
+        contours are mapped back to the full resolution.
+
+        :param frame_width int: The width of the whole frame, when the given
+                                frame is only a part of it.
+        :returns: list of 9 sorted (x, y, w, h) tuples, or an empty list
+        """
+        frame, scale, size_scale = profiler.time('downscale', self.downscale, frame, frame_width)
+        dilatedFrame = profiler.time('preprocess', self.preprocess, frame, size_scale)
+        contours = profiler.time('find_contours', self.find_contours, dilatedFrame, size_scale)
+        return [(x * scale, y * scale, w * scale, h * scale) for (x, y, w, h) in contours]
+
+    def find_contours(self, dilatedFrame, size_scale=1.0):
+        """
+        Find the contours of a 3x3x3 cube.
+
+        :param size_scale float: The scale of the sticker size limits, which
+                                 are relative to a DETECTION_WIDTH wide frame.
+        """
+        min_width = STICKER_MIN_WIDTH * size_scale
+        max_width = STICKER_MAX_WIDTH * size_scale
+        contours, hierarchy = cv2.findContours(dilatedFrame, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        final_contours = []
+
+        # Step 1/4: filter all contours to only those that are square-ish shapes.
+        for contour in contours:
+            # Cheap tests first. The bounding box of the approximated polygon
+            # can only be smaller than the one of the contour itself, so a
+            # contour that is too small here will never pass the tests below.
+            if len(contour) < 4:
+                continue
+            (_, _, w, h) = cv2.boundingRect(contour)
+            if w < min_width or h < min_width * 0.8:
+                continue
+            area = cv2.contourArea(contour)
+            if area <= 0.4 * min_width * min_width * 0.8:
+                continue
+
+            perimeter = cv2.arcLength(contour, True)
+            approx = cv2.approxPolyDP(contour, 0.1 * perimeter, True)
+            if len (approx) == 4:
+                (x, y, w, h) = cv2.boundingRect(approx)
+
+                # Find aspect ratio of boundary rectangle around the countours.
+                ratio = w / float(h)
+
+                # Check if contour is close to a square.
+                if ratio >= 0.8 and ratio <= 1.2 and w >= min_width and w <= max_width and area / (w * h) > 0.4:
+                    final_contours.append((x, y, w, h))
+
+        # Return early if we didn't found 9 or more contours.
+        if len(final_contours) < 9:
+            return []
+
+        # Step 2/4: Put every contour in all the cells of a grid that its
+        # bounding box overlaps. The cells are as big as the biggest contour,
+        # so every contour lands in at most 4 cells and each neighbor position
+        # below only has to be checked against the contours in its own cell.
+        cell_size = max(max(w, h) for (x, y, w, h) in final_contours)
+        grid = {}
+        for index, (x, y, w, h) in enumerate(final_contours):
+            for cell_x in range(x // cell_size, (x + w) // cell_size + 1):
+                for cell_y in range(y // cell_size, (y + h) // cell_size + 1):
+                    grid.setdefault((cell_x, cell_y), []).append(index)
+
+        # Step 3/4: Find the first contour that has 9 neighbors (including
+        # itself). This is the center piece of the cube and its neighbors are
+        # all the contours we're looking for.
+        #
+        # For every contour we create the 9 positions where its neighbors would
+        # be. The only way all of these can match is if the current contour is
+        # the center of the cube.
+        radius = 1.5
+        offsets = [(-1, -1), (0, -1), (1, -1), (-1, 0), (0, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
+        found = False
+        for (x, y, w, h) in final_contours:
+            center_x = x + w / 2
+            center_y = y + h / 2
+            matches = []
+            for position, (dx, dy) in enumerate(offsets):
+                x3 = center_x + dx * w * radius
+                y3 = center_y + dy * h * radius
+                cell = (int(x3 // cell_size), int(y3 // cell_size))
+                for neighbor_index in grid.get(cell, []):
+                    # The neighbor positions are located in the center of each
+                    # contour instead of top-left corner.
+                    # logic: (top left < center pos) and (bottom right > center pos)
+                    (x2, y2, w2, h2) = final_contours[neighbor_index]
+                    if (x2 < x3 and y2 < y3) and (x2 + w2 > x3 and y2 + h2 > y3):
+                        matches.append((neighbor_index, position))
+                if len(matches) > 9:
+                    break
+
+            if len(matches) == 9:
+                found = True
+                # Keep the same order as looping over all contours would give.
+                final_contours = [final_contours[index] for index, _ in sorted(matches)]
+                break
+
+        if not found:
+            return []
+
+        # Step 4/4: When we reached this part of the code we found a cube-like
+        # contour. The code below will sort all the contours on their X and Y
+        # values from the top-left to the bottom-right.
+
+        # Sort contours on the y-value first.
+        y_sorted = sorted(final_contours, key=lambda item: item[1])
+
+        # Split into 3 rows and sort each row on the x-value.
+        top_row = sorted(y_sorted[0:3], key=lambda item: item[0])
+        middle_row = sorted(y_sorted[3:6], key=lambda item: item[0])
+        bottom_row = sorted(y_sorted[6:9], key=lambda item: item[0])
+
+        sorted_contours = top_row + middle_row + bottom_row
+        return sorted_contours
+
+    def get_sticker_rois(self, frame, contours):
+        """
+        Get the region of interest within every sticker contour. The insets
+        are relative to the sticker size, so they work at any resolution.
+        """
+        rois = []
+        for (x, y, w, h) in contours:
+            inset_x = round(w * STICKER_ROI_INSET_X)
+            inset_y = round(h * STICKER_ROI_INSET_Y)
+            rois.append(frame[y+inset_y:y+h-inset_y, x+inset_x:x+w-inset_x])
+        return rois
+
+
+class CubeTracker:
+
+    def __init__(self, detector, margin=0.75, max_size_change=0.25):
+        """
+        :param detector CubeDetection: The detector to use.
+        :param margin float: How far to search around the last position,
+                             relative to the sticker size.
+        :param max_size_change float: How much the sticker size may change
+                                      between two frames to still trust it.
+        """
+        self.detector = detector
+        self.margin = margin
+        self.max_size_change = max_size_change
+        self.last_contours = []
+        self.tracked = 0
+        self.redetected = 0
+
+    def get_sticker_size(self, contours):
+        """Get the median sticker width of the given contours."""
+        return sorted(w for (x, y, w, h) in contours)[len(contours) // 2]
+
+    def track(self, frame):
+        """
+        Look for the cube in a small region around its last position.
+
+        :returns: list of 9 sorted (x, y, w, h) tuples, or an empty list
+        """
+        sticker_size = self.get_sticker_size(self.last_contours)
+        margin = int(sticker_size * self.margin)
+        frame_height, frame_width = frame.shape[:2]
+        x1 = max(0, min(x for (x, y, w, h) in self.last_contours) - margin)
+        y1 = max(0, min(y for (x, y, w, h) in self.last_contours) - margin)
+        x2 = min(frame_width, max(x + w for (x, y, w, h) in self.last_contours) + margin)
+        y2 = min(frame_height, max(y + h for (x, y, w, h) in self.last_contours) + margin)
+
+        contours = self.detector.detect(frame[y1:y2, x1:x2], frame_width)
+        if len(contours) != 9:
+            return []
+
+        # Only trust the result when the stickers are about as big as before.
+        size_change = abs(self.get_sticker_size(contours) / sticker_size - 1)
+        if size_change > self.max_size_change:
+            return []
+
+        return [(x + x1, y + y1, w, h) for (x, y, w, h) in contours]
+
+    def detect(self, frame):
+        """
+        Find the contours of a cube in the given BGR frame, by tracking it
+        from the previous frame and only detecting it in the whole frame when
+        that fails.
+
+        :returns: list of 9 sorted (x, y, w, h) tuples, or an empty list
+        """
+        if self.last_contours:
+            contours = self.track(frame)
+            if contours:
+                self.tracked += 1
+                self.last_contours = contours
+                return contours
+
+        self.redetected += 1
+        self.last_contours = self.detector.detect(frame)
+        return self.last_contours
+
+    def get_tracked_ratio(self):
+        """Get the ratio of frames that didn't need a full-frame detection."""
+        total = self.tracked + self.redetected
+        return self.tracked / total if total else 0.0
+
+
+class MotionGate:
+    """
+    Skip the detection while nothing in the scene moves, by comparing a tiny
+    grayscale version of every frame with the one of the last detection.
+    """
+
+    def __init__(self, detector, threshold=MOTION_THRESHOLD, width=MOTION_WIDTH):
+        """
+        :param detector CubeDetection|CubeTracker: The detector to gate.
+        :param threshold float: The share of pixels that have to change to
+                                detect again.
+        :param width int: The width to compare the frames at.
+        """
+        self.detector = detector
+        self.threshold = threshold
+        self.width = width
+        self.preprocessor = Preprocessor()
+        self.last_contours = []
+        self.reference_shape = None
+        self.skipped = 0
+        self.detected = 0
+
+    def get_thumbnail(self, frame):
+        """
+        Downscale a BGR frame to a tiny grayscale one to compare. Linear
+        interpolation only samples a few pixels, which is plenty to notice
+        motion and way cheaper than averaging all of them.
+        """
+        frame_height, frame_width = frame.shape[:2]
+        shape = (max(1, round(frame_height * self.width / frame_width)), self.width)
+        small = cv2.resize(
+            frame,
+            (shape[1], shape[0]),
+            dst=self.preprocessor.get_buffer('small', shape + (3,)),
+            interpolation=cv2.INTER_LINEAR
+        )
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=self.preprocessor.get_buffer('thumbnail', shape))
+
+    def get_motion(self, thumbnail):
+        """
+        Get the share of pixels that changed since the last detection.
+
+        :returns: float between 0 and 1, 1 when there is nothing to compare to
+        """
+        if self.reference_shape != thumbnail.shape:
+            return 1.0
+
+        shape = thumbnail.shape
+        reference = self.preprocessor.get_buffer('reference', shape)
+        difference = cv2.absdiff(thumbnail, reference, dst=self.preprocessor.get_buffer('difference', shape))
+        cv2.threshold(difference, MOTION_PIXEL_THRESHOLD, 255, cv2.THRESH_BINARY, dst=difference)
+        return cv2.countNonZero(difference) / difference.size
+
+    def detect(self, frame):
+        """
+        Find the contours of a cube in the given BGR frame, or reuse the last
+        ones when the scene didn't move.
+
+        :returns: list of 9 sorted (x, y, w, h) tuples, or an empty list
+        """
+        thumbnail = self.get_thumbnail(frame)
+        if self.get_motion(thumbnail) <= self.threshold:
+            self.skipped += 1
+            return self.last_contours
+
+        # Only move the reference along with a detection, so slow motion
+        # still adds up until it crosses the threshold.
+        self.preprocessor.get_buffer('reference', thumbnail.shape)[:] = thumbnail
+        self.reference_shape = thumbnail.shape
+        self.detected += 1
+        self.last_contours = self.detector.detect(frame)
+        return self.last_contours
+
+    def get_skipped_ratio(self):
+        """Get the ratio of frames that didn't need a detection."""
+        total = self.skipped + self.detected
+        return self.skipped / total if total else 0.0
+
+cube_detector = CubeDetection()
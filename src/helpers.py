@@ -3,6 +3,7 @@
 # vim: fenc=utf-8 ts=4 sw=4 et
 
 import math
+import numpy as np
 from constants import LOCALES
 
 def get_next_locale(locale):
@@ -139,3 +140,163 @@ def ciede2000(Lab_1, Lab_2):
 
     dE_00 = math.sqrt(f_L**2 + f_C**2 + f_H**2 + R_T * f_C * f_H)
     return dE_00
+
+def bgr2lab_batch(bgr):
+    """
+    Convert an array of BGR colors to LAB in one go.
+
+    This is the vectorized equivalent of bgr2lab, including its intermediate
+    rounding, so the results are equal up to float rounding differences in the
+    4th decimal (at most 1e-4 per channel).
+
+    :param bgr: array-like of shape (N, 3) or (3,) with BGR values.
+    :returns: np.ndarray of shape (N, 3)
+    """
+    bgr = np.asarray(bgr, dtype=np.float64).reshape(-1, 3)
+
+    # Convert BGR to RGB and linearize.
+    rgb = bgr[:, ::-1] / 255
+    rgb = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92) * 100
+
+    # Observer= 2°, Illuminant= D65
+    matrix = np.array([
+        [0.4124, 0.3576, 0.1805],
+        [0.2126, 0.7152, 0.0722],
+        [0.0193, 0.1192, 0.9505],
+    ])
+    xyz = np.round(rgb @ matrix.T, 4) / np.array([95.047, 100.0, 108.883])
+    xyz = np.where(xyz > 0.008856, xyz ** 0.3333333333333333, (7.787 * xyz) + (16 / 116))
+
+    lab = np.empty_like(xyz)
+    lab[:, 0] = (116 * xyz[:, 1]) - 16
+    lab[:, 1] = 500 * (xyz[:, 0] - xyz[:, 1])
+    lab[:, 2] = 200 * (xyz[:, 1] - xyz[:, 2])
+    return np.round(lab, 4)
+
+def ciede2000_batch(lab_1, lab_2):
+    """
+    Calculate the CIEDE2000 distance between every pair of two sets of
+    CIE L*a*b* colors.
+
+    This is the vectorized equivalent of ciede2000. Distances match the scalar
+    implementation within 1e-9, which means the closest color is identical
+    except for exact ties.
+
+    :param lab_1: array-like of shape (N, 3).
+    :param lab_2: array-like of shape (M, 3).
+    :returns: np.ndarray of shape (N, M)
+    """
+    C_25_7 = 6103515625 # 25**7
+
+    lab_1 = np.asarray(lab_1, dtype=np.float64).reshape(-1, 1, 3)
+    lab_2 = np.asarray(lab_2, dtype=np.float64).reshape(1, -1, 3)
+    L1, a1, b1 = lab_1[..., 0], lab_1[..., 1], lab_1[..., 2]
+    L2, a2, b2 = lab_2[..., 0], lab_2[..., 1], lab_2[..., 2]
+
+    C1 = np.sqrt(a1**2 + b1**2)
+    C2 = np.sqrt(a2**2 + b2**2)
+    C_ave = (C1 + C2) / 2
+    G = 0.5 * (1 - np.sqrt(C_ave**7 / (C_ave**7 + C_25_7)))
+
+    a1_, a2_ = (1 + G) * a1, (1 + G) * a2
+    C1_ = np.sqrt(a1_**2 + b1**2)
+    C2_ = np.sqrt(a2_**2 + b2**2)
+
+    # Same hue branches as the scalar version.
+    h1_ = np.arctan2(b1, a1_) + np.where(a1_ >= 0, 0, 2 * np.pi)
+    h1_ = np.where((b1 == 0) & (a1_ == 0), 0, h1_)
+    h2_ = np.arctan2(b2, a2_) + np.where(a2_ >= 0, 0, 2 * np.pi)
+    h2_ = np.where((b2 == 0) & (a2_ == 0), 0, h2_)
+
+    C1C2 = C1_ * C2_
+    dL_ = L2 - L1
+    dC_ = C2_ - C1_
+    dh_ = h2_ - h1_
+    dh_ = np.where(dh_ > np.pi, dh_ - 2 * np.pi, dh_)
+    dh_ = np.where(dh_ < -np.pi, dh_ + 2 * np.pi, dh_)
+    dh_ = np.where(C1C2 == 0, 0, dh_)
+    dH_ = 2 * np.sqrt(C1C2) * np.sin(dh_ / 2)
+
+    L_ave = (L1 + L2) / 2
+    C_ave = (C1_ + C2_) / 2
+
+    _dh = np.abs(h1_ - h2_)
+    _sh = h1_ + h2_
+    h_ave = np.where(_dh <= np.pi, _sh / 2,
+                     np.where(_sh < 2 * np.pi, _sh / 2 + np.pi, _sh / 2 - np.pi))
+    h_ave = np.where(C1C2 == 0, _sh, h_ave)
+
+    T = 1 - 0.17 * np.cos(h_ave - np.pi / 6) + 0.24 * np.cos(2 * h_ave) + 0.32 * np.cos(3 * h_ave + np.pi / 30) - 0.2 * np.cos(4 * h_ave - 63 * np.pi / 180)
+
+    h_ave_deg = h_ave * 180 / np.pi
+    h_ave_deg = np.where(h_ave_deg < 0, h_ave_deg + 360, h_ave_deg)
+    h_ave_deg = np.where(h_ave_deg > 360, h_ave_deg - 360, h_ave_deg)
+    dTheta = 30 * np.exp(-(((h_ave_deg - 275) / 25)**2))
+
+    R_C = 2 * np.sqrt(C_ave**7 / (C_ave**7 + C_25_7))
+    S_C = 1 + 0.045 * C_ave
+    S_H = 1 + 0.015 * C_ave * T
+
+    Lm50s = (L_ave - 50)**2
+    S_L = 1 + 0.015 * Lm50s / np.sqrt(20 + Lm50s)
+    R_T = -np.sin(dTheta * np.pi / 90) * R_C
+
+    f_L = dL_ / S_L
+    f_C = dC_ / S_C
+    f_H = dH_ / S_H
+
+    return np.sqrt(f_L**2 + f_C**2 + f_H**2 + R_T * f_C * f_H)
+
+def linear_sum_assignment(cost):
+    """
+    Assign every row to a different column with the lowest total cost, using
+    the Hungarian algorithm with potentials in O(n^2 m).
+
+    :param cost: array-like of shape (n, m) with n <= m.
+    :returns: np.ndarray of shape (n,) with the column of every row
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    n, m = cost.shape
+
+    # Everything is 1-based, row 0 and column 0 are used as sentinels.
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    row_of_column = np.zeros(m + 1, dtype=np.intp)
+    way = np.zeros(m + 1, dtype=np.intp)
+    for row in range(1, n + 1):
+        row_of_column[0] = row
+        column = 0
+        min_slack = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[column] = True
+            current_row = row_of_column[column]
+            free = ~used
+            free[0] = False
+            slack = np.full(m + 1, np.inf)
+            slack[1:] = cost[current_row - 1] - u[current_row] - v[1:]
+            improved = free & (slack < min_slack)
+            min_slack[improved] = slack[improved]
+            way[improved] = column
+
+            candidates = np.where(free, min_slack, np.inf)
+            next_column = int(np.argmin(candidates))
+            delta = candidates[next_column]
+            u[row_of_column[used]] += delta
+            v[used] -= delta
+            min_slack[free] -= delta
+
+            column = next_column
+            if row_of_column[column] == 0:
+                break
+
+        # Flip the augmenting path.
+        while column:
+            previous_column = way[column]
+            row_of_column[column] = row_of_column[previous_column]
+            column = previous_column
+
+    assignment = np.empty(n, dtype=np.intp)
+    columns = np.nonzero(row_of_column[1:])[0]
+    assignment[row_of_column[columns + 1] - 1] = columns
+    return assignment
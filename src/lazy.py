@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import threading
+
+
+class Lazy:
+    """
+    A proxy for a singleton that is only created when it's first used, so
+    importing its module doesn't do any I/O. Creating it is thread-safe, so it
+    can be warmed up on a background thread.
+    """
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_instance', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def get_instance(self):
+        """Get the singleton, creating it when it doesn't exist yet."""
+        instance = object.__getattribute__(self, '_instance')
+        if instance is None:
+            with object.__getattribute__(self, '_lock'):
+                instance = object.__getattribute__(self, '_instance')
+                if instance is None:
+                    instance = object.__getattribute__(self, '_factory')()
+                    object.__setattr__(self, '_instance', instance)
+        return instance
+
+    def set_instance(self, instance):
+        """Use the given singleton instead of creating it."""
+        with object.__getattribute__(self, '_lock'):
+            object.__setattr__(self, '_instance', instance)
+
+    def __getattr__(self, name):
+        return getattr(self.get_instance(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get_instance(), name, value)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import numpy as np
+import cv2
+
+
+class OverlayLayer:
+    """
+    A pre-rendered BGRA layer that is only rendered again when its key
+    changes, and otherwise copied onto every frame in the regions it covers.
+    """
+
+    def __init__(self):
+        self.key = None
+        self.shape = None
+        self.regions = []
+
+    def render(self, shape, key, draw):
+        """
+        Render the layer by letting draw() paint onto an empty BGRA image.
+
+        :param draw: function that takes the image and returns a list of
+                     (x1, y1, x2, y2) regions that it painted in.
+        """
+        height, width = shape[:2]
+        image = np.zeros((height, width, 4), dtype=np.uint8)
+        self.regions = []
+        for (x1, y1, x2, y2) in draw(image):
+            x1, y1 = max(0, int(x1)), max(0, int(y1))
+            x2, y2 = min(width, int(x2)), min(height, int(y2))
+            if x1 >= x2 or y1 >= y2:
+                continue
+            region = image[y1:y2, x1:x2]
+            self.regions.append((
+                (slice(y1, y2), slice(x1, x2)),
+                np.ascontiguousarray(region[:, :, :3]),
+                np.ascontiguousarray(region[:, :, 3])
+            ))
+        self.key = key
+        self.shape = shape
+
+    def composite(self, frame, key, draw):
+        """Copy the layer onto the frame, rendering it first when outdated."""
+        if key != self.key or frame.shape != self.shape:
+            self.render(frame.shape, key, draw)
+        for region, colors, mask in self.regions:
+            # This writes into the frame region in place.
+            cv2.copyTo(colors, mask, frame[region])
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import queue
+import threading
+import time
+from collections import deque
+
+
+class DropOldestQueue(queue.Queue):
+    """
+    A bounded queue that drops the oldest item when it is full instead of
+    blocking the producer, so consumers always get the newest frames.
+    """
+
+    def __init__(self, maxsize=1):
+        super().__init__(maxsize)
+        self.dropped = 0
+
+    def put(self, item, block=False, timeout=None):
+        """Put an item into the queue, dropping the oldest one when full."""
+        with self.not_full:
+            if self._qsize() >= self.maxsize:
+                self._get()
+                self.dropped += 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+class PipelineStats:
+    """Counters for the threaded webcam pipeline."""
+
+    def __init__(self, window=300):
+        self.lock = threading.Lock()
+        self.captured = 0
+        self.displayed = 0
+        self.latencies = deque(maxlen=window)
+
+    def frame_captured(self):
+        """Count a frame that has been read from the camera."""
+        with self.lock:
+            self.captured += 1
+
+    def frame_displayed(self, captured_at):
+        """Count a displayed frame and its capture-to-display latency."""
+        with self.lock:
+            self.displayed += 1
+            self.latencies.append(time.perf_counter() - captured_at)
+
+    def summary(self, dropped):
+        """
+        Get a summary of the counters.
+
+        :param dropped int: The amount of frames dropped by all the queues.
+        :returns: dict
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+        summary = {
+            'captured': self.captured,
+            'displayed': self.displayed,
+            'dropped': dropped,
+            'latency_avg_ms': 0.0,
+            'latency_max_ms': 0.0,
+        }
+        if latencies:
+            summary['latency_avg_ms'] = sum(latencies) / len(latencies) * 1000
+            summary['latency_max_ms'] = latencies[-1] * 1000
+        return summary
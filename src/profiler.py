@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import csv
+import json
+import os
+import threading
+import time
+from collections import deque
+import cv2
+import numpy as np
+from constants import PROFILER_WINDOW, PROFILER_HUD_COLOR
+
+
+class Profiler:
+    """
+    Time every stage of the webcam loop. Profiling is disabled until the HUD
+    is shown or a trace file is set, and a disabled profiler only costs a
+    single attribute check per stage.
+    """
+
+    def __init__(self, window=PROFILER_WINDOW):
+        """
+        :param window int: The amount of recent timings per stage to keep for
+                           the rolling statistics.
+        """
+        self.window = window
+        self.enabled = False
+        self.hud = False
+        self.collecting = False
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.frame = 0
+        self.last_frame_at = None
+        self.started_at = time.perf_counter()
+        self.trace_file = None
+        self.trace_writer = None
+        self.trace_format = None
+        self.trace_events = 0
+
+    def update_enabled(self):
+        """Only profile when somebody is looking at the results."""
+        self.enabled = self.hud or self.collecting or self.trace_file is not None
+
+    def start_collecting(self):
+        """
+        Forget all timings and keep every timing from now on instead of only
+        the recent ones, so the statistics cover a whole session.
+        """
+        with self.lock:
+            if not self.collecting:
+                self.recent_window = self.window
+            self.window = None
+            self.timings = {}
+        self.collecting = True
+        self.update_enabled()
+
+    def stop_collecting(self):
+        """Go back to only keeping the recent timings."""
+        if not self.collecting:
+            return
+        with self.lock:
+            self.window = self.recent_window
+            self.timings = {
+                name: deque(values, maxlen=self.window)
+                for name, values in self.timings.items()
+            }
+        self.collecting = False
+        self.update_enabled()
+
+    def toggle_hud(self):
+        """Show or hide the profiling HUD."""
+        self.hud = not self.hud
+        self.update_enabled()
+
+    def open_trace(self, path):
+        """
+        Write every timed stage to a file. Files ending with .csv get a CSV
+        trace, anything else a Chrome trace that can be opened with
+        chrome://tracing or https://ui.perfetto.dev.
+        """
+        self.trace_file = open(path, 'w', newline='')
+        if os.path.splitext(path)[1].lower() == '.csv':
+            self.trace_format = 'csv'
+            self.trace_writer = csv.writer(self.trace_file)
+            self.trace_writer.writerow(['frame', 'stage', 'thread', 'start_ms', 'duration_ms'])
+        else:
+            self.trace_format = 'chrome'
+            self.trace_file.write('[')
+        self.trace_events = 0
+        self.update_enabled()
+
+    def close_trace(self):
+        """Finish and close the trace file."""
+        with self.lock:
+            if self.trace_file is None:
+                return
+            if self.trace_format == 'chrome':
+                self.trace_file.write('\n]\n')
+            self.trace_file.close()
+            self.trace_file = None
+            self.trace_writer = None
+            self.trace_format = None
+        self.update_enabled()
+
+    def time(self, name, function, *args):
+        """Run a function and record how long it took under the given name."""
+        if not self.enabled:
+            return function(*args)
+        start = time.perf_counter()
+        result = function(*args)
+        self.record(name, start, time.perf_counter())
+        return result
+
+    def record(self, name, start, end):
+        """Record a single timing of a stage."""
+        with self.lock:
+            if name not in self.timings:
+                self.timings[name] = deque(maxlen=self.window)
+            self.timings[name].append(end - start)
+
+            if self.trace_format == 'csv':
+                self.trace_writer.writerow([
+                    self.frame,
+                    name,
+                    threading.current_thread().name,
+                    '{:.3f}'.format((start - self.started_at) * 1000),
+                    '{:.3f}'.format((end - start) * 1000),
+                ])
+            elif self.trace_format == 'chrome':
+                self.trace_file.write(',\n' if self.trace_events else '\n')
+                self.trace_file.write(json.dumps({
+                    'name': name,
+                    'ph': 'X',
+                    'pid': os.getpid(),
+                    'tid': threading.current_thread().name,
+                    'ts': (start - self.started_at) * 1e6,
+                    'dur': (end - start) * 1e6,
+                    'args': {'frame': self.frame},
+                }))
+            self.trace_events += 1
+
+    def frame_shown(self):
+        """Count a displayed frame and record the time since the previous one."""
+        now = time.perf_counter()
+        if self.enabled and self.last_frame_at is not None:
+            self.record('frame', self.last_frame_at, now)
+        self.last_frame_at = now
+        self.frame += 1
+
+    def summary(self):
+        """
+        Get the rolling statistics of every stage.
+
+        :returns: dict of the stage name to its p50, p95 and max in milliseconds
+        """
+        with self.lock:
+            timings = {name: list(values) for name, values in self.timings.items()}
+        summary = {}
+        for name, values in timings.items():
+            if not values:
+                continue
+            values = np.array(values) * 1000
+            summary[name] = {
+                'p50_ms': float(np.percentile(values, 50)),
+                'p95_ms': float(np.percentile(values, 95)),
+                'max_ms': float(values.max()),
+            }
+        return summary
+
+    def draw_hud(self, frame):
+        """Draw the rolling statistics of every stage onto the given frame."""
+        lines = ['{:<16}{:>7}{:>7}{:>7}'.format('stage (ms)', 'p50', 'p95', 'max')]
+        for name, stats in sorted(self.summary().items()):
+            lines.append('{:<16}{:>7.1f}{:>7.1f}{:>7.1f}'.format(
+                name, stats['p50_ms'], stats['p95_ms'], stats['max_ms']))
+
+        line_height = 16
+        x = frame.shape[1] - 330
+        y = 50
+        for index, line in enumerate(lines):
+            position = (x, y + line_height * (index + 1))
+            cv2.putText(frame, line, position, cv2.FONT_HERSHEY_PLAIN, 1, (0, 0, 0), 3, cv2.LINE_AA)
+            cv2.putText(frame, line, position, cv2.FONT_HERSHEY_PLAIN, 1, PROFILER_HUD_COLOR, 1, cv2.LINE_AA)
+
+profiler = Profiler()
@@ -2,47 +2,90 @@
 # -*- coding: utf-8 -*-
 # vim: fenc=utf-8 ts=4 sw=4 et
 
+import time
+STARTED_AT = time.perf_counter()
+
+# Everything else is imported only when it's needed, so that for example
+# --help doesn't have to load OpenCV, the config or the camera.
 import sys
-import kociemba
 import argparse
-from video import webcam
-import i18n
 import os
-from config import config
 from constants import (
     ROOT_DIR,
     E_INCORRECTLY_SCANNED,
-    E_ALREADY_SOLVED
+    E_ALREADY_SOLVED,
+    AUTO_CAPTURE_FRAMES
 )
 
-# Set default locale.
-locale = config.get_setting('locale')
-if not locale:
-    config.set_setting('locale', 'en')
+def init_i18n():
+    """Set the default locale and init i18n."""
+    import i18n
+    from config import config
+
+    # Set default locale.
     locale = config.get_setting('locale')
+    if not locale:
+        config.set_setting('locale', 'en')
+        locale = config.get_setting('locale')
 
-# Init i18n.
-i18n.load_path.append(os.path.join(ROOT_DIR, 'translations'))
-i18n.set('filename_format', '{locale}.{format}')
-i18n.set('file_format', 'json')
-i18n.set('locale', locale)
-i18n.set('fallback', 'en')
+    # Init i18n.
+    i18n.load_path.append(os.path.join(ROOT_DIR, 'translations'))
+    i18n.set('filename_format', '{locale}.{format}')
+    i18n.set('file_format', 'json')
+    i18n.set('locale', locale)
+    i18n.set('fallback', 'en')
 
 class Qbr:
 
-    def __init__(self, normalize):
+    def __init__(self, normalize, *, pipeline=False, track=False, resolution=None, startup=None, trace=None,
+                 auto_capture=0, motion_gate=False, record=None):
         self.normalize = normalize
+        self.pipeline = pipeline
+        self.track = track
+        self.motion_gate = motion_gate
+        self.record = record
+        self.resolution = resolution
+        self.startup = startup
+        self.trace = trace
+        self.auto_capture = auto_capture
 
     def run(self):
         """The main function that will run the Qbr program."""
-        state = webcam.run()
+        import i18n
+        from video import webcam
+        from solver import solver
+
+        if self.resolution:
+            webcam.set_resolution(*self.resolution)
+        if self.trace:
+            from profiler import profiler
+            profiler.open_trace(self.trace)
+        if self.record:
+            from session import SessionRecorder
+            webcam.recorder = SessionRecorder(self.record, {
+                'pipeline': self.pipeline,
+                'track': self.track,
+                'auto_capture': self.auto_capture,
+                'motion_gate': self.motion_gate,
+            })
+        state = None
+        try:
+            state = webcam.run(self.pipeline, self.track, self.auto_capture, self.motion_gate)
+        finally:
+            if self.trace:
+                profiler.close_trace()
+            if self.record:
+                webcam.recorder.close(state)
+
+        if self.startup:
+            self.startup.report(webcam.first_frame_at)
 
         # If we receive a number then it's an error code.
         if isinstance(state, int) and state > 0:
-            self.print_E_and_exit(state)
+            self.print_E_and_exit(state, webcam.get_sides_to_rescan())
 
         try:
-            algorithm = kociemba.solve(state)
+            algorithm = solver.get_solution(state)
             length = len(algorithm.split(' '))
         except Exception:
             self.print_E_and_exit(E_INCORRECTLY_SCANNED)
@@ -56,10 +99,19 @@ class Qbr:
                 text = i18n.t('solveManual.{}'.format(notation))
                 print('{}. {}'.format(index + 1, text))
 
-    def print_E_and_exit(self, code):
-        """Print an error message based on the code and exit the program."""
+    def print_E_and_exit(self, code, sides_to_rescan=None):
+        """
+        Print an error message based on the code and exit the program.
+
+        :param sides_to_rescan list: The color names of the sides that were
+                                     scanned wrong, if known.
+        """
+        import i18n
         if code == E_INCORRECTLY_SCANNED:
             print('\033[0;33m[{}] {}'.format(i18n.t('error'), i18n.t('haventScannedAllSides')))
+            if sides_to_rescan:
+                sides = ', '.join(i18n.t(side) for side in sides_to_rescan)
+                print(i18n.t('rescanSides', sides=sides))
             print('{}\033[0m'.format(i18n.t('pleaseTryAgain')))
         elif code == E_ALREADY_SOLVED:
             print('\033[0;33m[{}] {}'.format(i18n.t('error'), i18n.t('cubeAlreadySolved')))
@@ -76,7 +128,202 @@ if __name__ == '__main__':
         help='Shows the solution normalized. For example "R2" would be: \
               "Turn the right side 180 degrees".'
     )
+    parser.add_argument(
+        '-p',
+        '--pipeline',
+        default=False,
+        action='store_true',
+        help='Capture and detect frames on separate threads, always showing \
+              the newest frame.'
+    )
+    parser.add_argument(
+        '-t',
+        '--track',
+        default=False,
+        action='store_true',
+        help='Track the cube around its last position instead of searching \
+              the whole frame every time.'
+    )
+    parser.add_argument(
+        '-m',
+        '--motion-gate',
+        default=False,
+        action='store_true',
+        help='Only detect the cube again when something in the frame moved.'
+    )
+    parser.add_argument(
+        '-a',
+        '--auto-capture',
+        nargs='?',
+        type=int,
+        const=AUTO_CAPTURE_FRAMES,
+        default=0,
+        metavar='FRAMES',
+        help='Snapshot a face automatically once all stickers have been \
+              stable for FRAMES frames (default: {}).'.format(AUTO_CAPTURE_FRAMES)
+    )
+    parser.add_argument(
+        '-r',
+        '--resolution',
+        type=lambda value: tuple(int(v) for v in value.lower().split('x')),
+        default=None,
+        metavar='WIDTHxHEIGHT',
+        help='The webcam capture resolution (default: 640x480).'
+    )
+    parser.add_argument(
+        '--trace',
+        default=None,
+        metavar='FILE',
+        help='Write the timing of every stage of every frame to a file, as CSV \
+              when it ends with .csv and as a Chrome trace otherwise.'
+    )
+    parser.add_argument(
+        '--record',
+        default=None,
+        metavar='FILE',
+        help='Record every frame, the pressed keys, the scanned sides and the \
+              stage timings to a session file.'
+    )
+    parser.add_argument(
+        '--replay',
+        default=None,
+        metavar='FILE',
+        help='Replay a session file without the webcam and compare the result \
+              and stage timings with the recording. Exits with 1 when the \
+              result is different.'
+    )
+    parser.add_argument(
+        '--realtime',
+        default=False,
+        action='store_true',
+        help='Replay a session at the recorded speed instead of as fast as \
+              possible.'
+    )
+    parser.add_argument(
+        '--startup-profile',
+        default=False,
+        action='store_true',
+        help='Print how long each part of the startup took, including the \
+              time to the first frame.'
+    )
+    parser.add_argument(
+        '-s',
+        '--scan',
+        nargs='+',
+        metavar='PATH',
+        help='Scan images, directories of images or video files without the \
+              webcam and print one JSON line per cube.'
+    )
+    parser.add_argument(
+        '-c',
+        '--cameras',
+        nargs='+',
+        metavar='SOURCE',
+        help='Scan with several cameras at once, each in its own process, and \
+              print one JSON line per solved cube. A source is a camera \
+              index, a device path or a video file. Faces are captured \
+              automatically.'
+    )
+    parser.add_argument(
+        '-b',
+        '--batch',
+        nargs='?',
+        const='-',
+        default=None,
+        metavar='FILE',
+        help='Solve one state per line of FILE, or of stdin when omitted, and \
+              print one JSON line per state.'
+    )
+    parser.add_argument(
+        '--unordered',
+        default=False,
+        action='store_true',
+        help='Print the results of --batch as soon as they are solved, \
+              instead of in the order of the input.'
+    )
+    parser.add_argument(
+        '--serve',
+        nargs='?',
+        const=True,
+        default=None,
+        metavar='SOCKET',
+        help='Keep running and answer JSON requests to solve states, classify \
+              face images or get the live scan state on a Unix domain socket \
+              (default: qbr.sock in the config directory).'
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=None,
+        help='Also answer requests over HTTP on this localhost port with --serve.'
+    )
+    parser.add_argument(
+        '--source',
+        default=None,
+        help='The camera index, device path or video file to scan live from \
+              with --serve.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='Amount of processes to use with --scan and --batch, or to solve \
+              with --cameras (default: all cores).'
+    )
+    parser.add_argument(
+        '--frame-step',
+        type=int,
+        default=1,
+        help='Only scan every n-th frame of a video with --scan.'
+    )
     args = parser.parse_args()
 
+    if args.scan:
+        from scanner import Scanner
+        Scanner(args.workers, args.frame_step).run(args.scan)
+        sys.exit(0)
+
+    if args.batch:
+        from batch import Batch
+        if args.normalize:
+            init_i18n()
+        Batch(args.workers, not args.unordered, args.normalize).run(args.batch)
+        sys.exit(0)
+
+    if args.serve:
+        from server import Server
+        socket_path = args.serve if isinstance(args.serve, str) else None
+        try:
+            Server(socket_path, args.port, args.source, args.auto_capture).run()
+        except FileExistsError as e:
+            sys.exit('qbr: {}'.format(e))
+        sys.exit(0)
+
+    if args.cameras:
+        from stations import Stations
+        Stations(args.cameras, args.workers, args.auto_capture, args.track, args.motion_gate).run()
+        sys.exit(0)
+
+    init_i18n()
+
+    if args.replay:
+        from session import SessionReplay
+        sys.exit(0 if SessionReplay(args.replay, args.realtime).run() else 1)
+
+    # Warm up everything in parallel while the webcam is starting.
+    from startup import Startup
+    startup = Startup(STARTED_AT)
+    startup.start()
+
     # Run Qbr with all arguments.
-    Qbr(args.normalize).run()
+    Qbr(
+        args.normalize,
+        pipeline=args.pipeline,
+        track=args.track,
+        resolution=args.resolution,
+        startup=startup if args.startup_profile else None,
+        trace=args.trace,
+        auto_capture=args.auto_capture,
+        motion_gate=args.motion_gate,
+        record=args.record
+    ).run()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import os
+import sys
+import json
+import math
+import multiprocessing
+from collections import Counter
+import cv2
+import numpy as np
+from colordetection import color_detector
+from cubedetection import cube_detector
+from solver import solver
+from validator import FACES, validate, get_faces_to_rescan, is_solved
+from constants import (
+    IMAGE_EXTENSIONS,
+    E_INCORRECTLY_SCANNED,
+    E_ALREADY_SOLVED
+)
+
+
+def scan_frame(frame):
+    """
+    Detect and classify a single cube face in a BGR frame.
+
+    :returns: list of 9 (color_name, distance, bgr) tuples with the raw BGR
+              color of every sticker, or None
+    """
+    contours = cube_detector.detect(frame)
+    if len(contours) != 9:
+        return None
+    rois = cube_detector.get_sticker_rois(frame, contours)
+    dominant_colors = color_detector.get_dominant_colors(rois)
+    return [
+        (closest['color_name'], closest['distance'], tuple(float(c) for c in bgr))
+        for closest, bgr in zip(color_detector.get_closest_colors(dominant_colors), dominant_colors)
+    ]
+
+def classify_cube(faces):
+    """
+    Classify the stickers of all six faces together, so that every color is
+    used exactly 9 times, like the webcam does.
+
+    :param faces dict: The center color name of every face to its 9
+                       (color_name, distance, bgr) tuples.
+    :returns: dict of center color name -> list of 9 (color_name, distance)
+    """
+    sides = list(faces.keys())
+    samples = [sticker[2] for side in sides for sticker in faces[side]]
+    colors = color_detector.assign_balanced_colors(samples, list(range(4, 54, 9)))
+    _, distances = color_detector.get_color_scores(samples)
+    palette_indices = [color_detector.palette_names.index(side) for side in sides]
+
+    state = {side: [] for side in sides}
+    for index, color in enumerate(colors):
+        distance = float(distances[index, palette_indices[color]])
+        state[sides[index // 9]].append((sides[color], distance))
+    return state
+
+def scan_image(path):
+    """Scan the face in an image file."""
+    frame = cv2.imread(path)
+    if frame is None:
+        return []
+    face = scan_frame(frame)
+    return [face] if face else []
+
+def scan_video(args):
+    """Scan the faces in every step-th frame within [start, stop) of a video."""
+    path, start, stop, step = args
+    cam = cv2.VideoCapture(path)
+    cam.set(cv2.CAP_PROP_POS_FRAMES, start)
+    faces = []
+    for index in range(start, stop):
+        # Grabbing is cheap, only decode the frames we actually scan.
+        if not cam.grab():
+            break
+        if index % step != 0:
+            continue
+        ok, frame = cam.retrieve()
+        if not ok:
+            continue
+        face = scan_frame(frame)
+        if face:
+            faces.append(face)
+    cam.release()
+    return faces
+
+
+class Scanner:
+
+    def __init__(self, workers=None, frame_step=1):
+        self.workers = workers or os.cpu_count() or 1
+        self.frame_step = max(1, frame_step)
+
+    def is_image(self, path):
+        """Check if the given path is an image file based on its extension."""
+        return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+    def get_jobs(self, paths):
+        """
+        Group the given paths into cubes to scan. Loose image files together
+        form a single cube, every directory and every video file is a cube on
+        its own.
+
+        :returns: list of (source, function, units) tuples
+        """
+        jobs = []
+        images = []
+        for path in paths:
+            if os.path.isdir(path):
+                files = sorted(os.path.join(path, name) for name in os.listdir(path))
+                units = [f for f in files if self.is_image(f)]
+                jobs.append((path, scan_image, units))
+            elif self.is_image(path):
+                images.append(path)
+            else:
+                jobs.append((path, scan_video, self.get_video_units(path)))
+
+        if images:
+            jobs.insert(0, (images, scan_image, images))
+        return jobs
+
+    def get_video_units(self, path):
+        """Split a video in chunks of frames, so they can be scanned in parallel."""
+        cam = cv2.VideoCapture(path)
+        frame_count = int(cam.get(cv2.CAP_PROP_FRAME_COUNT))
+        cam.release()
+        if frame_count <= 0:
+            return []
+
+        chunk_size = max(self.frame_step, math.ceil(frame_count / (self.workers * 4)))
+        return [
+            (path, start, min(start + chunk_size, frame_count), self.frame_step)
+            for start in range(0, frame_count, chunk_size)
+        ]
+
+    def combine_faces(self, faces):
+        """
+        Combine all scanned faces into one state. Faces are identified by
+        their center color and every sticker gets the most common color among
+        all scans of that face, and the median raw color of those scans.
+
+        :returns: dict of center color name -> list of 9
+                  (color_name, distance, bgr)
+        """
+        grouped = {}
+        for face in faces:
+            grouped.setdefault(face[4][0], []).append(face)
+
+        state = {}
+        for side, side_faces in grouped.items():
+            state[side] = []
+            for index in range(9):
+                names = [face[index][0] for face in side_faces]
+                color_name = Counter(names).most_common(1)[0][0]
+                stickers = [face[index] for face in side_faces if face[index][0] == color_name]
+                distance = sum(sticker[1] for sticker in stickers) / len(stickers)
+                bgr = tuple(float(c) for c in np.median([sticker[2] for sticker in stickers], axis=0))
+                state[side].append((color_name, distance, bgr))
+        return state
+
+    def get_result(self, source, faces):
+        """
+        Turn the scanned faces of a cube into a result with a solution, or
+        with the sides to scan again when the state can't be solved.
+        """
+        result = {
+            'source': source,
+            'faces_scanned': len(faces),
+            'state': None,
+            'distances': None,
+            'solution': None,
+            'moves': None,
+            'error': None,
+            'rescan': None,
+        }
+        # Order must be URFDLB (white, red, green, yellow, orange, blue)
+        sides = ['white', 'red', 'green', 'yellow', 'orange', 'blue']
+
+        state = self.combine_faces(faces)
+        if len(state.keys()) != 6:
+            result['error'] = E_INCORRECTLY_SCANNED
+            result['rescan'] = [side for side in sides if side not in state]
+            return result
+
+        state = classify_cube(state)
+        stickers = [sticker for side in sides for sticker in state[side]]
+        result['state'] = ''.join(color_detector.notations[name] for name, _ in stickers)
+        result['distances'] = [round(distance, 4) for _, distance in stickers]
+
+        if is_solved(result['state']):
+            result['error'] = E_ALREADY_SOLVED
+            return result
+
+        errors = validate(result['state'])
+        if errors:
+            result['error'] = E_INCORRECTLY_SCANNED
+            result['rescan'] = [sides[FACES.index(face)] for face in get_faces_to_rescan(errors)]
+            return result
+
+        try:
+            algorithm = solver.solve(result['state'])
+            result['solution'] = algorithm
+            result['moves'] = len(algorithm.split(' '))
+        except Exception:
+            result['error'] = E_INCORRECTLY_SCANNED
+        return result
+
+    def scan(self, paths):
+        """
+        Scan all the given paths across multiple processes.
+
+        Yields a result for every cube in the order of the given paths.
+        """
+        jobs = self.get_jobs(paths)
+
+        # Make sure the palette lookup table exists before the workers
+        # classify colors, see ColorDetection.update_palette_lut.
+        color_detector.get_instance()
+        with multiprocessing.Pool(self.workers) as pool:
+            # Submit everything upfront so all cores stay busy, but collect
+            # the results per cube in order.
+            pending = [
+                (source, [pool.apply_async(function, (unit,)) for unit in units])
+                for source, function, units in jobs
+            ]
+            for source, async_results in pending:
+                faces = []
+                for async_result in async_results:
+                    faces.extend(async_result.get())
+                yield self.get_result(source, faces)
+
+    def run(self, paths):
+        """Scan all the given paths and print one JSON line per cube."""
+        for result in self.scan(paths):
+            sys.stdout.write(json.dumps(result) + '\n')
+            sys.stdout.flush()
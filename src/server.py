@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import os
+import stat
+import json
+import base64
+import signal
+import threading
+import time
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import cv2
+import kociemba
+from colordetection import color_detector
+from solver import solver
+from profiler import Profiler
+from scanner import scan_frame, classify_cube
+from stations import get_source
+from validator import validate, get_message, is_solved
+from config import config
+from constants import (
+    AUTO_CAPTURE_FRAMES,
+    SERVER_SOCKET_FILENAME,
+    WARM_UP_STATE
+)
+
+
+class UnixRequestHandler(socketserver.StreamRequestHandler):
+    """Handle one JSON request per line, answering with one JSON line each."""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = None
+            response = self.server.qbr.handle(request)
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class HTTPRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handle GET /state and GET /metrics, and POST /solve and POST /classify
+    with the request as JSON body.
+    """
+
+    def do_GET(self):
+        self.respond({'method': self.path.strip('/')})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            request['method'] = self.path.strip('/')
+        except (ValueError, AttributeError, TypeError):
+            request = None
+        self.respond(request)
+
+    def respond(self, request):
+        response = self.server.qbr.handle(request)
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(400 if 'error' in response else 200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Server:
+    """
+    Keep everything warm and answer requests on a Unix domain socket and
+    optionally on a localhost HTTP port. Every request is handled on a
+    thread of its own.
+
+    Requests are JSON objects with a "method" and its parameters:
+
+    - solve: solve the "state" given in rubik's cube notation.
+    - classify: classify the face in every image of "images", which are file
+      paths or objects with base64 encoded image "data".
+    - state: get the state of the live scan.
+    - metrics: get the latency of every method.
+    """
+
+    def __init__(self, socket_path=None, port=None, source=None, auto_capture=AUTO_CAPTURE_FRAMES):
+        """
+        :param socket_path str: The Unix domain socket to listen on.
+        :param port int: The localhost HTTP port to listen on, if any.
+        :param source str: The camera to scan live from, if any.
+        """
+        self.socket_path = socket_path or os.path.join(config.config_dir, SERVER_SOCKET_FILENAME)
+        self.port = port
+        self.source = None if source is None else get_source(source)
+        self.auto_capture = auto_capture or AUTO_CAPTURE_FRAMES
+        self.webcam = None
+        self.webcam_lock = threading.Lock()
+        self.stop = threading.Event()
+        self.metrics = Profiler()
+        self.metrics_lock = threading.Lock()
+        self.requests = {}
+        self.errors = {}
+        self.methods = {
+            'solve': self.solve,
+            'classify': self.classify,
+            'state': self.get_state,
+            'metrics': self.get_metrics,
+        }
+
+    def warm_up(self):
+        """Load the color palette and the kociemba tables upfront."""
+        color_detector.get_instance()
+        kociemba.solve(WARM_UP_STATE)
+
+    def handle(self, request):
+        """
+        Handle a single request.
+
+        :returns: dict with either the "result" or an "error", and the
+                  "latency_ms" of the request
+        """
+        start = time.perf_counter()
+        method = request.get('method') if isinstance(request, dict) else None
+        response = {}
+        try:
+            if method not in self.methods:
+                raise ValueError('Unknown method: {}'.format(method))
+            response['result'] = self.methods[method](request)
+        except Exception as e:
+            response['error'] = str(e) or e.__class__.__name__
+        end = time.perf_counter()
+
+        with self.metrics_lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            if 'error' in response:
+                self.errors[method] = self.errors.get(method, 0) + 1
+        self.metrics.record(str(method), start, end)
+
+        response['latency_ms'] = (end - start) * 1000
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        return response
+
+    def solve(self, request):
+        """Solve a state given in rubik's cube notation."""
+        state = request.get('state')
+        if not isinstance(state, str) or len(state) != 54:
+            raise ValueError('The state must be a string of 54 facelets.')
+        errors = validate(state)
+        if errors:
+            raise ValueError('Invalid state: {}'.format(get_message(errors)))
+        if is_solved(state):
+            raise ValueError('The cube is already solved.')
+        algorithm = solver.solve(state)
+        return {
+            'solution': algorithm,
+            'moves': len(algorithm.split(' ')),
+        }
+
+    def read_image(self, image):
+        """Read an image from a file path or from base64 encoded data."""
+        if isinstance(image, dict):
+            data = np.frombuffer(base64.b64decode(image['data']), dtype=np.uint8)
+            return cv2.imdecode(data, cv2.IMREAD_COLOR)
+        return cv2.imread(image)
+
+    def classify(self, request):
+        """
+        Classify the face in every image. When the images are the six faces
+        of a cube, all stickers are classified together so that every color
+        is used exactly 9 times.
+
+        :returns: list of 9 {color_name, distance} dicts per image, or None
+                  when no face was found
+        """
+        faces = []
+        for image in request.get('images', []):
+            frame = self.read_image(image)
+            faces.append(scan_frame(frame) if frame is not None else None)
+
+        centers = set(face[4][0] for face in faces if face)
+        if len(faces) == 6 and len(centers) == 6 and all(faces):
+            state = classify_cube({face[4][0]: face for face in faces})
+            faces = [state[face[4][0]] for face in faces]
+
+        return [
+            face and [
+                {'color_name': sticker[0], 'distance': round(sticker[1], 4)}
+                for sticker in face
+            ]
+            for face in faces
+        ]
+
+    def get_state(self, request):
+        """Get the state of the live scan."""
+        if self.source is None:
+            raise ValueError('There is no live scan, start the server with a source.')
+        if self.webcam is None:
+            raise ValueError('The camera is still starting.')
+        with self.webcam_lock:
+            result = self.webcam.get_result()
+            return {
+                'preview': [color_detector.get_closest_color(bgr)['color_name'] for bgr in self.webcam.preview_state],
+                'confidences': [round(float(c), 3) for c in self.webcam.preview_confidences],
+                'faces_scanned': sorted(self.webcam.result_state.keys()),
+                'state': result if isinstance(result, str) else None,
+                'error': result if isinstance(result, int) else None,
+            }
+
+    def get_metrics(self, request):
+        """Get the amount of requests, errors and the latency per method."""
+        summary = self.metrics.summary()
+        with self.metrics_lock:
+            return {
+                method: dict(
+                    requests=count,
+                    errors=self.errors.get(method, 0),
+                    **summary.get(str(method), {})
+                )
+                for method, count in self.requests.items()
+            }
+
+    def live_scan(self):
+        """Keep scanning faces from the camera on a background thread."""
+        from video import Webcam
+        webcam = Webcam(self.source)
+        webcam.auto_capture_frames = self.auto_capture
+        self.webcam = webcam
+        while not self.stop.is_set():
+            ok, frame = webcam.cam.read()
+            if not ok:
+                time.sleep(0.01)
+                continue
+            contours = webcam.detect(frame)
+            with self.webcam_lock:
+                webcam.frame = frame
+                webcam.update_state(255, contours)
+        webcam.cam.release()
+
+    def remove_socket(self):
+        """
+        Remove the socket file, but never any other kind of file that's at
+        the socket path.
+
+        :returns: False when another kind of file is at the socket path
+        """
+        try:
+            if not stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                return False
+            os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def run(self):
+        """
+        Serve until interrupted or terminated.
+
+        :raises FileExistsError: When a file that isn't a socket is at the
+                                 socket path.
+        """
+        # A socket that is left behind by an earlier server can be removed.
+        if not self.remove_socket():
+            raise FileExistsError('{} exists and is not a socket'.format(self.socket_path))
+
+        self.warm_up()
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop.set())
+        servers = [UnixServer(self.socket_path, UnixRequestHandler)]
+        print('Listening on {}'.format(self.socket_path))
+        if self.port:
+            servers.append(ThreadingHTTPServer(('127.0.0.1', self.port), HTTPRequestHandler))
+            print('Listening on http://127.0.0.1:{}'.format(self.port))
+
+        threads = []
+        for server in servers:
+            server.qbr = self
+            threads.append(threading.Thread(target=server.serve_forever, daemon=True))
+        if self.source is not None:
+            threads.append(threading.Thread(target=self.live_scan, daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            self.stop.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop.set()
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+            self.remove_socket()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+Record a webcam session into a single file and replay it without a camera.
+
+A session file is a zip file with every processed frame as a PNG image in the
+frames directory, and a session.json with the options and settings it was
+recorded with, the key that was pressed on every frame, the sides that were
+scanned over time, the final result and the timing of every stage.
+"""
+
+import json
+import queue
+import threading
+import time
+import zipfile
+import cv2
+import numpy as np
+import i18n
+from colordetection import color_detector
+from textrenderer import text_renderer
+from profiler import profiler
+from config import config
+from constants import SESSION_VERSION, SESSION_PNG_COMPRESSION, SESSION_QUEUE_SIZE
+
+FRAME_PATH = 'frames/{:06d}.png'
+SESSION_PATH = 'session.json'
+
+
+class SessionRecorder:
+    """
+    Keep track of every processed frame, the key that was pressed and the
+    scanned sides, and write them to a session file if a path is given.
+
+    Compressing a frame takes longer than processing it, so frames are
+    written on a thread of their own. The webcam loop only waits for it when
+    SESSION_QUEUE_SIZE frames are waiting to be written.
+    """
+
+    def __init__(self, path=None, options=None):
+        """
+        :param path str: The session file to write, or None to only keep
+                         track of the keys and states.
+        :param options dict: The options the webcam runs with.
+        """
+        self.file = None
+        if path:
+            self.file = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED)
+            self.frames_to_write = queue.Queue(SESSION_QUEUE_SIZE)
+            self.writer = threading.Thread(target=self.write_frames, name='session', daemon=True)
+            self.writer.start()
+        self.options = options or {}
+        self.frames = []
+        self.states = []
+        self.sides = []
+        self.width = None
+        self.height = None
+        self.locale = config.get_setting('locale')
+        self.palette = dict(color_detector.cube_color_palette)
+        self.color_models = color_detector.color_models
+        self.dominant_color_estimator = color_detector.dominant_color_estimator
+        self.started_at = time.perf_counter()
+        profiler.start_collecting()
+
+    def write_frames(self):
+        """Compress and write the recorded frames until None is received."""
+        while True:
+            item = self.frames_to_write.get()
+            if item is None:
+                return
+            index, frame = item
+            _, data = cv2.imencode('.png', frame, [cv2.IMWRITE_PNG_COMPRESSION, SESSION_PNG_COMPRESSION])
+            self.file.writestr(FRAME_PATH.format(index), data.tobytes())
+
+    def record_frame(self, frame, key):
+        """
+        Record a captured frame, before anything is drawn onto it. Frames
+        that couldn't be read aren't recorded.
+        """
+        if frame is None:
+            return
+        if self.file:
+            self.frames_to_write.put((len(self.frames), frame.copy()))
+        self.height, self.width = frame.shape[:2]
+        self.frames.append({
+            'time': round(time.perf_counter() - self.started_at, 6),
+            'key': key,
+        })
+
+    def record_state(self, result_state):
+        """Record the scanned sides whenever they change."""
+        sides = sorted(result_state.keys())
+        if sides != self.sides:
+            self.sides = sides
+            self.states.append({'frame': len(self.frames) - 1, 'sides': sides})
+
+    def close(self, result):
+        """
+        Stop recording and write the session file.
+
+        :param result str|int: The scanned state or an error code.
+        :returns: dict of the session
+        """
+        session = {
+            'version': SESSION_VERSION,
+            'options': self.options,
+            'width': self.width,
+            'height': self.height,
+            'locale': self.locale,
+            'palette': self.palette,
+            'color_models': self.color_models,
+            'dominant_color_estimator': self.dominant_color_estimator,
+            'frames': self.frames,
+            'states': self.states,
+            'result': result,
+            'stages': profiler.summary(),
+        }
+        profiler.stop_collecting()
+        if self.file:
+            self.frames_to_write.put(None)
+            self.writer.join()
+            self.file.writestr(SESSION_PATH, json.dumps(session))
+            self.file.close()
+            self.file = None
+        return session
+
+
+class SessionCamera:
+    """Read the frames and keys of a session file like a cv2.VideoCapture."""
+
+    def __init__(self, file, session, realtime=False):
+        """
+        :param file zipfile.ZipFile: The opened session file.
+        :param realtime bool: Wait in between frames like when they were
+                              recorded, instead of reading them right away.
+        """
+        self.file = file
+        self.frames = session['frames']
+        self.width = session['width'] or 0
+        self.height = session['height'] or 0
+        self.realtime = realtime
+        self.index = -1
+        self.started_at = None
+
+    def read(self):
+        """Read the next frame, returns False when there are none left."""
+        self.index += 1
+        if self.index >= len(self.frames):
+            return False, None
+
+        if self.realtime:
+            recorded_at = self.frames[self.index]['time']
+            if self.started_at is None:
+                self.started_at = time.perf_counter() - recorded_at
+            delay = self.started_at + recorded_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        data = np.frombuffer(self.file.read(FRAME_PATH.format(self.index)), dtype=np.uint8)
+        return True, cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+    def wait_key(self, delay):
+        """Get the key of the last read frame, escape once all are read."""
+        if self.index >= len(self.frames):
+            return 27
+        return self.frames[self.index]['key']
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        return 0
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        pass
+
+
+class SessionReplay:
+    """
+    Feed the frames and keys of a session file through the webcam loop again,
+    with the options and settings it was recorded with, and compare the
+    result and the stage timings with the recording.
+    """
+
+    def __init__(self, path, realtime=False):
+        """
+        :param path str: The session file to replay.
+        :param realtime bool: Replay at the recorded speed instead of as fast
+                              as possible.
+        """
+        self.path = path
+        self.realtime = realtime
+
+    def save_settings(self):
+        """Keep the current settings, since the keys of a session can change them."""
+        return {
+            'settings': json.loads(json.dumps(config.settings)),
+            'locale': i18n.get('locale'),
+            'palette': dict(color_detector.cube_color_palette),
+            'color_models': color_detector.color_models,
+            'dominant_color_estimator': color_detector.dominant_color_estimator,
+        }
+
+    def apply_settings(self, settings):
+        """Use the locale and colors of a session or of saved settings."""
+        i18n.set('locale', settings['locale'])
+        text_renderer.set_locale(settings['locale'])
+        color_detector.dominant_color_estimator = settings['dominant_color_estimator']
+        color_detector.set_cube_color_pallete(settings['palette'], settings['color_models'])
+
+    def restore_settings(self, saved):
+        """Restore the settings from before the replay."""
+        if config.settings != saved['settings']:
+            config.settings = saved['settings']
+            config.save()
+        self.apply_settings(saved)
+
+    def replay(self):
+        """
+        Replay the session file.
+
+        :returns: tuple of the recorded and the replayed session
+        """
+        from video import Webcam
+
+        with zipfile.ZipFile(self.path, 'r') as file:
+            session = json.loads(file.read(SESSION_PATH).decode('utf-8'))
+            if session.get('version') != SESSION_VERSION:
+                raise ValueError('Unsupported session version: {}'.format(session.get('version')))
+
+            saved = self.save_settings()
+            try:
+                self.apply_settings(session)
+                camera = SessionCamera(file, session, self.realtime)
+                webcam = Webcam(camera)
+                webcam.read_key = camera.wait_key
+                webcam.headless = True
+                webcam.recorder = SessionRecorder(options=session['options'])
+
+                # Frames are always replayed one after another, recording in
+                # pipeline mode only kept the frames that were displayed.
+                options = session['options']
+                result = webcam.run(
+                    track=options.get('track', False),
+                    auto_capture=options.get('auto_capture', 0),
+                    motion_gate=options.get('motion_gate', False)
+                )
+                replayed = webcam.recorder.close(result)
+            finally:
+                self.restore_settings(saved)
+        return session, replayed
+
+    def print_report(self, recorded, replayed):
+        """Print the differences between the recorded and the replayed session."""
+        print('frames: {} recorded, {} replayed'.format(len(recorded['frames']), len(replayed['frames'])))
+        print('result: {}'.format('same' if recorded['result'] == replayed['result'] else 'different'))
+        print('  recorded: {}'.format(recorded['result']))
+        print('  replayed: {}'.format(replayed['result']))
+
+        if recorded['states'] != replayed['states']:
+            for index, (before, after) in enumerate(zip(recorded['states'] + [None], replayed['states'] + [None])):
+                if before != after:
+                    print('states: different from side change {}'.format(index + 1))
+                    print('  recorded: {}'.format(before))
+                    print('  replayed: {}'.format(after))
+                    break
+        else:
+            print('states: same')
+
+        print('{:<22} {:>12} {:>12} {:>10}'.format('stage', 'recorded ms', 'replayed ms', 'change'))
+        for name, stats in sorted(replayed['stages'].items()):
+            base = recorded['stages'].get(name)
+            if base:
+                print('{:<22} {:>12.3f} {:>12.3f} {:>10}'.format(
+                    name, base['p50_ms'], stats['p50_ms'], '{:+.1f}%'.format((stats['p50_ms'] / base['p50_ms'] - 1) * 100)))
+            else:
+                print('{:<22} {:>12} {:>12.3f} {:>10}'.format(name, '-', stats['p50_ms'], ''))
+
+    def run(self):
+        """
+        Replay the session file and print how it compares to the recording.
+
+        :returns: True when the result and the scanned sides are the same
+        """
+        recorded, replayed = self.replay()
+        self.print_report(recorded, replayed)
+        return recorded['result'] == replayed['result'] and recorded['states'] == replayed['states']
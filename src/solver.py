@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import os
+import json
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import kociemba
+from config import config
+from constants import SOLUTION_CACHE_FILENAME, SOLUTION_CACHE_SIZE
+
+
+class Solver:
+
+    def __init__(self):
+        self.cache = None
+        self.lock = threading.RLock()
+        self.executor = None
+        self.pending = {}
+
+    @property
+    def cache_file(self):
+        return os.path.join(config.config_dir, SOLUTION_CACHE_FILENAME)
+
+    def read_cache(self):
+        """Read the solution cache from disk, least recently used first."""
+        try:
+            with open(self.cache_file, 'r') as f:
+                return OrderedDict(json.load(f))
+        except Exception:
+            return OrderedDict()
+
+    def load_cache(self):
+        """Load the solution cache from disk."""
+        self.cache = self.read_cache()
+
+    def save_cache(self):
+        """
+        Save the solution cache to disk.
+
+        Several processes can share the cache file, so the solutions that
+        other processes saved in the meantime are merged in as the least
+        recently used ones. Every process writes its own temporary file, when
+        two processes save at the same time the last one wins.
+        """
+        cache = OrderedDict(
+            (state, algorithm)
+            for state, algorithm in self.read_cache().items()
+            if state not in self.cache
+        )
+        cache.update(self.cache)
+        while len(cache) > SOLUTION_CACHE_SIZE:
+            cache.popitem(last=False)
+        self.cache = cache
+
+        try:
+            fd, tmp_file = tempfile.mkstemp(dir=config.config_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(list(self.cache.items()), f)
+                os.replace(tmp_file, self.cache_file)
+            except OSError:
+                os.remove(tmp_file)
+                raise
+        except OSError:
+            pass
+
+    def get_cached_solution(self, state):
+        """Get the cached solution of a state, or None."""
+        with self.lock:
+            if self.cache is None:
+                self.load_cache()
+            if state not in self.cache:
+                return None
+            self.cache.move_to_end(state)
+            return self.cache[state]
+
+    def set_cached_solution(self, state, algorithm):
+        """Cache a solution, evicting the least recently used ones."""
+        with self.lock:
+            if self.cache is None:
+                self.load_cache()
+            self.cache[state] = algorithm
+            self.cache.move_to_end(state)
+            while len(self.cache) > SOLUTION_CACHE_SIZE:
+                self.cache.popitem(last=False)
+            self.save_cache()
+
+    def solve(self, state):
+        """
+        Solve a state given in rubik's cube notation, using the cache when the
+        state has been solved before.
+
+        :raises ValueError: When the state can't be solved.
+        :returns: str
+        """
+        algorithm = self.get_cached_solution(state)
+        if algorithm is None:
+            algorithm = kociemba.solve(state)
+            self.set_cached_solution(state, algorithm)
+        return algorithm
+
+    def solve_async(self, state):
+        """
+        Start solving a state in the background, so the solution is ready by
+        the time it's needed.
+
+        :returns: concurrent.futures.Future
+        """
+        with self.lock:
+            if state not in self.pending:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=1)
+                future = self.executor.submit(self.solve, state)
+                self.pending[state] = future
+                future.add_done_callback(lambda _: self.remove_pending(state))
+                return future
+            return self.pending[state]
+
+    def remove_pending(self, state):
+        """Forget a finished background solve, its result is in the cache."""
+        with self.lock:
+            self.pending.pop(state, None)
+
+    def get_solution(self, state):
+        """Get the solution of a state, waiting for a background solve if any."""
+        return self.solve_async(state).result()
+
+solver = Solver()
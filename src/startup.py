@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import importlib
+import threading
+import time
+from constants import TEXT_SIZE, WARM_UP_STATE
+
+
+class Startup:
+    """
+    Warm up the camera, fonts, translations, color palette and kociemba
+    tables on background threads, and time how long every step takes.
+    """
+
+    def __init__(self, started_at):
+        """
+        :param started_at float: time.perf_counter() when the process started.
+        """
+        self.started_at = started_at
+        self.timings = []
+        self.lock = threading.Lock()
+
+    def measure(self, name, function, *args):
+        """Run a function and record how long it took under the given name."""
+        start = time.perf_counter()
+        result = function(*args)
+        with self.lock:
+            self.timings.append((name, start - self.started_at, time.perf_counter() - start))
+        return result
+
+    def import_module(self, name):
+        """Import a module and record how long it took."""
+        return self.measure('import {}'.format(name), importlib.import_module, name)
+
+    def warm_up_camera(self):
+        """Open the camera, which is by far the slowest part."""
+        self.import_module('cv2')
+        video = self.import_module('video')
+        self.measure('open camera', video.webcam.get_instance)
+
+    def warm_up_fonts(self):
+        """Load the fonts used by the user interface."""
+        textrenderer = self.import_module('textrenderer')
+        for size in [TEXT_SIZE, int(TEXT_SIZE * 1.25)]:
+            self.measure('load font {}'.format(size), textrenderer.text_renderer.get_font, size)
+
+    def warm_up_translations(self):
+        """Load the translations of the current locale."""
+        i18n = self.import_module('i18n')
+        self.measure('load translations', i18n.t, 'language')
+
+    def warm_up_colors(self):
+        """Load the color palette and its lookup table."""
+        colordetection = self.import_module('colordetection')
+        self.measure('load color palette', colordetection.color_detector.get_instance)
+
+    def warm_up_solver(self):
+        """Solve a state once, which loads the kociemba tables."""
+        kociemba = self.import_module('kociemba')
+        self.measure('load kociemba tables', kociemba.solve, WARM_UP_STATE)
+
+    def run_warm_up(self, warm_up):
+        """
+        Run a warm up step. Warming up is best-effort, any error shows up
+        again when the part is actually used.
+        """
+        try:
+            warm_up()
+        except Exception:
+            pass
+
+    def start(self):
+        """Start all warm up steps in parallel."""
+        for warm_up in [
+            self.warm_up_camera,
+            self.warm_up_fonts,
+            self.warm_up_translations,
+            self.warm_up_colors,
+            self.warm_up_solver,
+        ]:
+            threading.Thread(target=self.run_warm_up, args=(warm_up,), daemon=True).start()
+
+    def report(self, first_frame_at=None):
+        """Print the startup timings, in the order they started."""
+        print('Startup profile:')
+        with self.lock:
+            timings = sorted(self.timings, key=lambda timing: timing[1])
+        for name, started, elapsed in timings:
+            print('  {:<28} {:>8.1f}ms  (at {:.1f}ms)'.format(name, elapsed * 1000, started * 1000))
+        if first_frame_at is not None:
+            print('  {:<28} {:>8.1f}ms'.format('time to first frame', (first_frame_at - self.started_at) * 1000))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import os
+import sys
+import signal
+import json
+import queue
+import threading
+import time
+import multiprocessing
+import kociemba
+from colordetection import color_detector
+from solver import solver
+from constants import (
+    AUTO_CAPTURE_FRAMES,
+    STATION_MAX_READ_FAILURES,
+    PIPELINE_READ_RETRY_DELAY,
+    E_INCORRECTLY_SCANNED
+)
+
+
+def get_source(value):
+    """Get a camera index from a string of digits, otherwise keep the path."""
+    return int(value) if value.isdigit() else value
+
+def run_station(source, results, stop, auto_capture, track, motion_gate):
+    """
+    Scan cubes from a single camera in a process of its own, sending the
+    state of every fully scanned cube to the results queue.
+    """
+    # The stdout of the main process only contains results.
+    sys.stdout = sys.stderr
+
+    # Ctrl-C is handled by the main process, which stops all stations.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Importing the webcam module in the main process isn't needed, so only
+    # import it here.
+    from cubedetection import cube_detector, CubeTracker, MotionGate
+    from video import Webcam
+
+    webcam = Webcam(source)
+    webcam.auto_capture_frames = auto_capture
+    webcam.solve_in_background = False
+    if track:
+        webcam.tracker = CubeTracker(cube_detector)
+    if motion_gate:
+        webcam.motion_gate = MotionGate(webcam.tracker or cube_detector)
+
+    cube = 0
+    failures = 0
+    while not stop.is_set() and failures < STATION_MAX_READ_FAILURES:
+        ok, frame = webcam.cam.read()
+        if not ok:
+            failures += 1
+            time.sleep(PIPELINE_READ_RETRY_DELAY)
+            continue
+        failures = 0
+
+        webcam.frame = frame
+        webcam.update_state(255, webcam.detect(frame))
+        if len(webcam.result_state.keys()) == 6:
+            state = webcam.get_result()
+            results.put((source, cube, state))
+            cube += 1
+            webcam.start_next_cube()
+
+    webcam.cam.release()
+
+
+class Stations:
+    """
+    Scan with several cameras at once. Every camera runs capture and
+    detection in its own process, the scanned states are solved by a shared
+    pool of processes and the results are printed as JSON lines.
+    """
+
+    def __init__(self, sources, workers=None, auto_capture=AUTO_CAPTURE_FRAMES, track=False, motion_gate=False):
+        """
+        :param sources list: Camera indices, device paths or video files.
+        :param workers int: The amount of solver processes.
+        """
+        self.sources = [get_source(source) for source in sources]
+        self.workers = workers or os.cpu_count() or 1
+        self.auto_capture = auto_capture or AUTO_CAPTURE_FRAMES
+        self.track = track
+        self.motion_gate = motion_gate
+        self.print_lock = threading.Lock()
+
+    def print_result(self, source, cube, state, solution=None, error=None):
+        """Print the result of a single cube as a JSON line."""
+        result = {
+            'source': source,
+            'cube': cube,
+            'state': state if isinstance(state, str) else None,
+            'solution': solution,
+            'moves': len(solution.split(' ')) if solution else None,
+            'error': error,
+        }
+        with self.print_lock:
+            sys.stdout.write(json.dumps(result) + '\n')
+            sys.stdout.flush()
+
+    def solve(self, pool, source, cube, state):
+        """Solve a state on the pool, or print it right away if possible."""
+        if isinstance(state, int):
+            self.print_result(source, cube, state, error=state)
+            return
+
+        solution = solver.get_cached_solution(state)
+        if solution is not None:
+            self.print_result(source, cube, state, solution)
+            return
+
+        def on_solution(solution):
+            solver.set_cached_solution(state, solution)
+            self.print_result(source, cube, state, solution)
+
+        def on_error(_):
+            self.print_result(source, cube, state, error=E_INCORRECTLY_SCANNED)
+
+        pool.apply_async(kociemba.solve, (state,), callback=on_solution, error_callback=on_error)
+
+    def run(self):
+        """Run all cameras until they end or until interrupted."""
+        # Every station classifies colors, so build the palette lookup table
+        # here, once, see ColorDetection.update_palette_lut.
+        color_detector.get_instance()
+
+        results = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        stations = [
+            multiprocessing.Process(
+                target=run_station,
+                args=(source, results, stop, self.auto_capture, self.track, self.motion_gate),
+                daemon=True
+            )
+            for source in self.sources
+        ]
+        for station in stations:
+            station.start()
+
+        # Ctrl-C is handled here, the solvers are stopped along with the pool.
+        with multiprocessing.Pool(self.workers, signal.signal, (signal.SIGINT, signal.SIG_IGN)) as pool:
+            try:
+                while any(station.is_alive() for station in stations) or not results.empty():
+                    try:
+                        source, cube, state = results.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    self.solve(pool, source, cube, state)
+            except KeyboardInterrupt:
+                stop.set()
+
+            for station in stations:
+                station.join()
+            pool.close()
+            pool.join()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+import numpy as np
+from constants import STICKER_FILTER_SIZE
+
+
+class StickerFilter:
+    """
+    A temporal majority vote over the palette indices of every sticker.
+
+    The last `size` palette indices of every sticker are kept in a ring
+    buffer, together with the vote count of every palette color, which are
+    both updated in place for all stickers at once on every frame.
+    """
+
+    def __init__(self, stickers=9, colors=6, size=STICKER_FILTER_SIZE):
+        """
+        :param stickers int: The amount of stickers to filter.
+        :param colors int: The amount of colors in the palette.
+        :param size int: The amount of frames to vote over.
+        """
+        self.stickers = stickers
+        self.colors = colors
+        self.size = size
+        self.rows = np.arange(stickers)
+        self.buffer = np.zeros((stickers, size), dtype=np.intp)
+        self.counts = np.zeros((stickers, colors), dtype=np.int32)
+        self.winners = np.zeros(stickers, dtype=np.intp)
+        self.position = 0
+        self.filled = 0
+
+    def reset(self):
+        """Forget all the votes, for example when another face is shown."""
+        self.counts[:] = 0
+        self.position = 0
+        self.filled = 0
+
+    def update(self, palette_indices):
+        """
+        Add the palette indices of the current frame and vote again.
+
+        :param palette_indices np.ndarray: The palette index of every sticker.
+        :returns: np.ndarray of the winning palette index of every sticker
+        """
+        palette_indices = np.asarray(palette_indices, dtype=np.intp)
+
+        # Remove the votes of the frame that drops out of the ring buffer.
+        # Every row is indexed once, so plain fancy indexing is enough.
+        if self.filled == self.size:
+            self.counts[self.rows, self.buffer[:, self.position]] -= 1
+        else:
+            self.filled += 1
+
+        self.buffer[:, self.position] = palette_indices
+        self.counts[self.rows, palette_indices] += 1
+        self.position = (self.position + 1) % self.size
+
+        # Only let the winner change when another color has strictly more
+        # votes, so ties don't make the preview flicker.
+        most_votes = self.counts.max(axis=1)
+        keep = self.counts[self.rows, self.winners] == most_votes
+        self.winners = np.where(keep, self.winners, self.counts.argmax(axis=1))
+        return self.winners
+
+    def get_confidences(self):
+        """
+        Get the share of the votes that went to the winner of every sticker.
+
+        :returns: np.ndarray of floats between 0 and 1
+        """
+        if self.filled == 0:
+            return np.zeros(self.stickers)
+        return self.counts[self.rows, self.winners] / self.filled
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+from collections import OrderedDict
+from PIL import ImageFont, ImageDraw, Image
+import numpy as np
+from constants import FONT_PATH, TEXT_SIZE, TEXT_SPRITE_CACHE_SIZE
+
+
+class TextRenderer:
+
+    def __init__(self, font_path=FONT_PATH):
+        self.font_path = font_path
+        self.fonts = {}
+        self.sprites = OrderedDict()
+        self.locale = None
+
+    def get_font(self, size=TEXT_SIZE):
+        """Load the truetype font with the specified text size, only once."""
+        if size not in self.fonts:
+            self.fonts[size] = ImageFont.truetype(self.font_path, size)
+        return self.fonts[size]
+
+    def get_text_size(self, text, size=TEXT_SIZE):
+        """Get the width and height of the given text."""
+        left, top, right, bottom = self.get_font(size).getbbox(text)
+        return right - left, bottom - top
+
+    def set_locale(self, locale):
+        """Evict all cached sprites when the locale switches."""
+        if locale != self.locale:
+            self.sprites.clear()
+            self.locale = locale
+
+    def get_sprite(self, text, color, size, anchor):
+        """
+        Get the text rendered with a shadow as a sprite.
+
+        :returns: tuple of the (h, w, 3) color array, the (h, w, 1) alpha mask
+                  and the offset of the sprite relative to the anchor
+        """
+        key = (text, size, color, anchor, self.locale)
+        if key in self.sprites:
+            self.sprites.move_to_end(key)
+            return self.sprites[key]
+
+        font = self.get_font(size)
+        left, top, right, bottom = font.getbbox(text, anchor=anchor, stroke_width=1)
+        image = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        draw.text((-left, -top), text, font=font, fill=color, anchor=anchor,
+                  stroke_width=1, stroke_fill=(0, 0, 0))
+
+        pixels = np.array(image)
+        sprite = (
+            pixels[:, :, :3].astype(np.uint16),
+            pixels[:, :, 3:].astype(np.uint16),
+            (left, top)
+        )
+        self.sprites[key] = sprite
+        if len(self.sprites) > TEXT_SPRITE_CACHE_SIZE:
+            self.sprites.popitem(last=False)
+        return sprite
+
+    def render(self, frame, text, pos, color=(255, 255, 255), size=TEXT_SIZE, anchor='lt'):
+        """
+        Render text with a shadow onto the frame, in place. Only the region
+        that the text covers is blended.
+        """
+        colors, alpha, (left, top) = self.get_sprite(text, tuple(color), size, anchor)
+        height, width = alpha.shape[:2]
+        x = int(round(pos[0])) + left
+        y = int(round(pos[1])) + top
+
+        # Clip the sprite to the frame.
+        x1, y1 = max(x, 0), max(y, 0)
+        x2, y2 = min(x + width, frame.shape[1]), min(y + height, frame.shape[0])
+        if x1 >= x2 or y1 >= y2:
+            return
+        sx1, sy1 = x1 - x, y1 - y
+        sx2, sy2 = sx1 + (x2 - x1), sy1 + (y2 - y1)
+
+        region = frame[y1:y2, x1:x2]
+        mask = alpha[sy1:sy2, sx1:sx2]
+        blended = colors[sy1:sy2, sx1:sx2] * mask + region * (255 - mask)
+        region[:] = (blended + 127) // 255
+
+text_renderer = TextRenderer()
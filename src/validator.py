@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8 ts=4 sw=4 et
+
+"""
+Validate a cube state in rubik's cube notation before solving it, and find
+out which sides need to be scanned again.
+"""
+
+from collections import Counter
+
+FACES = 'URFDLB'
+
+# Facelet indices of every corner and edge position, in URFDLB order. The
+# first facelet of a corner is on the U or D side, the first facelet of an
+# edge on the U or D side, or on the F or B side for the middle layer.
+CORNER_FACELETS = [
+    (8, 9, 20), (6, 18, 38), (0, 36, 47), (2, 45, 11),
+    (29, 26, 15), (27, 44, 24), (33, 53, 42), (35, 17, 51),
+]
+EDGE_FACELETS = [
+    (5, 10), (7, 19), (3, 37), (1, 46), (32, 16), (28, 25),
+    (30, 43), (34, 52), (23, 12), (21, 41), (50, 39), (48, 14),
+]
+CORNER_COLORS = ['URF', 'UFL', 'ULB', 'UBR', 'DFR', 'DLF', 'DBL', 'DRB']
+EDGE_COLORS = ['UR', 'UF', 'UL', 'UB', 'DR', 'DF', 'DL', 'DB', 'FR', 'FL', 'BL', 'BR']
+
+# Error codes, roughly from the most to the least specific.
+E_LENGTH = 'length'
+E_CENTERS = 'centers'
+E_COLORS = 'colors'
+E_CORNER = 'corner'
+E_EDGE = 'edge'
+E_DUPLICATE_CORNER = 'duplicate_corner'
+E_DUPLICATE_EDGE = 'duplicate_edge'
+E_TWIST = 'twist'
+E_FLIP = 'flip'
+E_PARITY = 'parity'
+
+
+def get_permutation_parity(permutation):
+    """Get the parity of a permutation, 0 for even and 1 for odd."""
+    parity = 0
+    for i in range(len(permutation)):
+        for j in range(i + 1, len(permutation)):
+            if permutation[i] > permutation[j]:
+                parity ^= 1
+    return parity
+
+def get_error(code, faces=(), pieces=()):
+    """Create an error with the sides and pieces it's about."""
+    return {
+        'code': code,
+        'faces': sorted(set(faces), key=FACES.index),
+        'pieces': list(pieces),
+    }
+
+def get_corner(colors):
+    """
+    Identify a corner by its colors.
+
+    :param colors str: The colors of the corner facelets, in URFDLB notation.
+    :returns: tuple of the corner index and its twist, or None when no corner
+              has these colors
+    """
+    for twist in range(3):
+        if colors[twist] in 'UD':
+            piece = colors[twist:] + colors[:twist]
+            if piece in CORNER_COLORS:
+                return CORNER_COLORS.index(piece), twist
+    return None
+
+def get_edge(colors):
+    """
+    Identify an edge by its colors.
+
+    :param colors str: The colors of the edge facelets, in URFDLB notation.
+    :returns: tuple of the edge index and its flip, or None when no edge has
+              these colors
+    """
+    if colors in EDGE_COLORS:
+        return EDGE_COLORS.index(colors), 0
+    if colors[::-1] in EDGE_COLORS:
+        return EDGE_COLORS.index(colors[::-1]), 1
+    return None
+
+def validate(state):
+    """
+    Check that a state is a solvable cube, without solving it.
+
+    The facelets may use any 6 symbols, the centers define which side every
+    symbol belongs to.
+
+    :param state str: 54 facelets in URFDLB order.
+    :returns: list of errors, empty when the state is valid. Every error has a
+              'code', the 'faces' (in URFDLB notation) to scan again and the
+              'pieces' (by their solved position, e.g. 'URF') that are wrong.
+    """
+    if len(state) != 54:
+        return [get_error(E_LENGTH, FACES)]
+
+    # Map every symbol to the side of the center that has it.
+    centers = state[4::9]
+    if len(set(centers)) != 6:
+        duplicates = [FACES[i] for i, center in enumerate(centers) if centers.count(center) > 1]
+        return [get_error(E_CENTERS, duplicates)]
+    sides = {center: FACES[i] for i, center in enumerate(centers)}
+    facelets = [sides.get(symbol) for symbol in state]
+
+    errors = []
+    counts = Counter(facelets)
+    if any(counts[face] != 9 for face in FACES) or None in counts:
+        wrong = [face for face in FACES if counts[face] > 9] + ([None] if None in counts else [])
+        faces = [FACES[i // 9] for i, facelet in enumerate(facelets) if facelet in wrong]
+        errors.append(get_error(E_COLORS, faces))
+
+    corners = []
+    for position, indices in enumerate(CORNER_FACELETS):
+        colors = [facelets[i] for i in indices]
+        corner = None if None in colors else get_corner(''.join(colors))
+        if corner is None:
+            errors.append(get_error(E_CORNER, [FACES[i // 9] for i in indices], [CORNER_COLORS[position]]))
+        corners.append(corner)
+
+    edges = []
+    for position, indices in enumerate(EDGE_FACELETS):
+        colors = [facelets[i] for i in indices]
+        edge = None if None in colors else get_edge(''.join(colors))
+        if edge is None:
+            errors.append(get_error(E_EDGE, [FACES[i // 9] for i in indices], [EDGE_COLORS[position]]))
+        edges.append(edge)
+
+    # Every piece must be there exactly once.
+    for code, pieces, facelet_table, names in [
+        (E_DUPLICATE_CORNER, corners, CORNER_FACELETS, CORNER_COLORS),
+        (E_DUPLICATE_EDGE, edges, EDGE_FACELETS, EDGE_COLORS),
+    ]:
+        piece_counts = Counter(piece[0] for piece in pieces if piece)
+        duplicates = [
+            position for position, piece in enumerate(pieces)
+            if piece and piece_counts[piece[0]] > 1
+        ]
+        if duplicates:
+            faces = [FACES[i // 9] for position in duplicates for i in facelet_table[position]]
+            errors.append(get_error(code, faces, [names[position] for position in duplicates]))
+
+    if errors:
+        return errors
+
+    # All pieces are there, so the cube can only be unsolvable because of a
+    # twisted corner, a flipped edge or two swapped pieces, which can't be
+    # pinned down to a single side.
+    if sum(twist for _, twist in corners) % 3:
+        errors.append(get_error(E_TWIST, FACES))
+    if sum(flip for _, flip in edges) % 2:
+        errors.append(get_error(E_FLIP, FACES))
+    corner_parity = get_permutation_parity([corner for corner, _ in corners])
+    edge_parity = get_permutation_parity([edge for edge, _ in edges])
+    if corner_parity != edge_parity:
+        errors.append(get_error(E_PARITY, FACES))
+    return errors
+
+def is_solved(state):
+    """Check if every side of a state has a single color."""
+    return all(len(set(state[index:index + 9])) == 1 for index in range(0, 54, 9))
+
+def get_faces_to_rescan(errors):
+    """Get all sides that have to be scanned again, in URFDLB notation."""
+    faces = set(face for error in errors for face in error['faces'])
+    return sorted(faces, key=FACES.index)
+
+def get_message(errors):
+    """Describe the errors in a single line, e.g. 'corner URF, twist'."""
+    return ', '.join(
+        ' '.join([error['code']] + error['pieces'])
+        for error in errors
+    )
@@ -3,16 +3,26 @@
 # vim: fenc=utf-8 ts=4 sw=4 et
 
 import cv2
+import numpy as np
+import queue
+import threading
+import time
 from colordetection import color_detector
+from cubedetection import cube_detector, CubeTracker, MotionGate
+from textrenderer import text_renderer
+from overlay import OverlayLayer
+from solver import solver
+from lazy import Lazy
 from config import config
-from helpers import get_next_locale
+from helpers import get_next_locale, bgr2lab_batch, ciede2000_batch
 import i18n
-from PIL import ImageFont, ImageDraw, Image
-import numpy as np
+from stickerfilter import StickerFilter
+from validator import validate, get_faces_to_rescan
+from pipeline import DropOldestQueue, PipelineStats
+from profiler import profiler
 from constants import (
     COLOR_PLACEHOLDER,
     LOCALES,
-    ROOT_DIR,
     CUBE_PALETTE,
     MINI_STICKER_AREA_TILE_SIZE,
     MINI_STICKER_AREA_TILE_GAP,
@@ -23,22 +33,64 @@ from constants import (
     STICKER_CONTOUR_COLOR,
     CALIBRATE_MODE_KEY,
     SWITCH_LANGUAGE_KEY,
+    PROFILER_HUD_KEY,
     TEXT_SIZE,
+    WINDOW_TITLE,
+    CAPTURE_WIDTH,
+    CAPTURE_HEIGHT,
+    PIPELINE_QUEUE_SIZE,
+    PIPELINE_READ_RETRY_DELAY,
+    PIPELINE_MAX_READ_FAILURES,
+    AUTO_CAPTURE_CONFIDENCE,
+    CALIBRATION_FRAMES,
+    CALIBRATION_MAX_DISTANCE,
+    COLOR_MODELS,
     E_INCORRECTLY_SCANNED,
     E_ALREADY_SOLVED
 )
 
 class Webcam:
 
-    def __init__(self):
+    def __init__(self, source=0):
+        """
+        :param source int|str: The camera index, device path or video file,
+                               or anything that reads frames like a
+                               cv2.VideoCapture.
+        """
         print('Starting webcam... (this might take a while, please be patient)')
-        self.cam = cv2.VideoCapture(0)
+        self.cam = source if hasattr(source, 'read') else cv2.VideoCapture(source)
         print('Webcam successfully started')
 
+        # Keys come from the window, unless they're replayed. Without a
+        # window nothing is shown.
+        self.read_key = cv2.waitKey
+        self.headless = False
+        self.recorder = None
+
         self.colors_to_calibrate = ['green', 'red', 'blue', 'orange', 'white', 'yellow']
-        self.average_sticker_colors = {}
+        self.sticker_filter = StickerFilter()
+        self.preview_confidences = np.zeros(9)
+
+        # Auto-capture is disabled when the amount of frames is 0.
+        self.auto_capture_frames = 0
+        self.stable_frames = 0
+        self.stable_preview_state = None
+
+        # The face that was in front of the camera when the previous cube was
+        # done, which isn't captured until another face is shown.
+        self.ignored_preview_state = None
+
+        # Start solving as soon as all sides are scanned, unless somebody else
+        # takes care of solving.
+        self.solve_in_background = True
         self.result_state = {}
 
+        # The raw sticker colors of the preview and of every scanned side,
+        # before they're matched against the palette.
+        self.preview_samples = []
+        self.result_samples = {}
+        self.validation_errors = []
+
         self.snapshot_state = [(255,255,255), (255,255,255), (255,255,255),
                                (255,255,255), (255,255,255), (255,255,255),
                                (255,255,255), (255,255,255), (255,255,255)]
@@ -46,18 +98,41 @@ class Webcam:
                                (255,255,255), (255,255,255), (255,255,255),
                                (255,255,255), (255,255,255), (255,255,255)]
 
-        self.cam.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        self.cam.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-        self.width = int(self.cam.get(cv2.CAP_PROP_FRAME_WIDTH))
-        self.height = int(self.cam.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.set_resolution(CAPTURE_WIDTH, CAPTURE_HEIGHT)
 
         self.calibrate_mode = False
         self.calibrated_colors = {}
+        self.calibration_samples = {}
+        self.calibration_frames_left = 0
         self.current_color_to_calibrate_index = 0
         self.done_calibrating = False
 
-    def draw_stickers(self, stickers, offset_x, offset_y):
-        """Draws the given stickers onto the given frame."""
+        self.tracker = None
+        self.motion_gate = None
+        self.first_frame_at = None
+
+        # Pre-rendered sticker overlays, only rendered again when they change.
+        self.preview_layer = OverlayLayer()
+        self.snapshot_layer = OverlayLayer()
+        self.cube_state_layer = OverlayLayer()
+        text_renderer.set_locale(config.get_setting('locale'))
+
+    def set_resolution(self, width, height):
+        """
+        Request a capture resolution from the camera. The camera may pick
+        another resolution, so the actual resolution is read back.
+        """
+        self.cam.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.cam.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self.width = int(self.cam.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cam.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    def draw_stickers(self, image, stickers, offset_x, offset_y):
+        """
+        Draws the given stickers onto the given BGRA layer image.
+
+        :returns: tuple of the (x1, y1, x2, y2) region that was drawn in
+        """
         index = -1
         for row in range(3):
             for col in range(3):
@@ -69,152 +144,48 @@ class Webcam:
 
                 # shadow
                 cv2.rectangle(
-                    self.frame,
+                    image,
                     (x1, y1),
                     (x2, y2),
-                    (0, 0, 0),
+                    (0, 0, 0, 255),
                     -1
                 )
 
                 # foreground color
                 cv2.rectangle(
-                    self.frame,
+                    image,
                     (x1 + 1, y1 + 1),
                     (x2 - 1, y2 - 1),
-                    color_detector.get_prominent_color(stickers[index]),
+                    color_detector.get_prominent_color(stickers[index]) + (255,),
                     -1
                 )
 
+        size = STICKER_AREA_TILE_SIZE * 3 + STICKER_AREA_TILE_GAP * 2
+        return (offset_x, offset_y, offset_x + size + 1, offset_y + size + 1)
+
     def draw_preview_stickers(self):
         """Draw the current preview state onto the given frame."""
-        self.draw_stickers(self.preview_state, STICKER_AREA_OFFSET, STICKER_AREA_OFFSET)
+        key = (tuple(self.preview_state), tuple(color_detector.palette_bgr))
+        self.preview_layer.composite(self.frame, key, lambda image: [
+            self.draw_stickers(image, self.preview_state, STICKER_AREA_OFFSET, STICKER_AREA_OFFSET)
+        ])
 
     def draw_snapshot_stickers(self):
         """Draw the current snapshot state onto the given frame."""
         y = STICKER_AREA_TILE_SIZE * 3 + STICKER_AREA_TILE_GAP * 2 + STICKER_AREA_OFFSET * 2
-        self.draw_stickers(self.snapshot_state, STICKER_AREA_OFFSET, y)
-
-    def find_contours(self, dilatedFrame):
-        """Find the contours of a 3x3x3 cube."""
-        contours, hierarchy = cv2.findContours(dilatedFrame, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        final_contours = []
-
-        # Step 1/4: filter all contours to only those that are square-ish shapes.
-        for contour in contours:
-            perimeter = cv2.arcLength(contour, True)
-            approx = cv2.approxPolyDP(contour, 0.1 * perimeter, True)
-            if len (approx) == 4:
-                area = cv2.contourArea(contour)
-                (x, y, w, h) = cv2.boundingRect(approx)
-
-                # Find aspect ratio of boundary rectangle around the countours.
-                ratio = w / float(h)
-
-                # Check if contour is close to a square.
-                if ratio >= 0.8 and ratio <= 1.2 and w >= 30 and w <= 60 and area / (w * h) > 0.4:
-                    final_contours.append((x, y, w, h))
-
-        # Return early if we didn't found 9 or more contours.
-        if len(final_contours) < 9:
-            return []
-
-        # Step 2/4: Find the contour that has 9 neighbors (including itself)
-        # and return all of those neighbors.
-        found = False
-        contour_neighbors = {}
-        for index, contour in enumerate(final_contours):
-            (x, y, w, h) = contour
-            contour_neighbors[index] = []
-            center_x = x + w / 2
-            center_y = y + h / 2
-            radius = 1.5
-
-            # Create 9 positions for the current contour which are the
-            # neighbors. We'll use this to check how many neighbors each contour
-            # has. The only way all of these can match is if the current contour
-            # is the center of the cube. If we found the center, we also know
-            # all the neighbors, thus knowing all the contours and thus knowing
-            # this shape can be considered a 3x3x3 cube. When we've found those
-            # contours, we sort them and return them.
-            neighbor_positions = [
-                # top left
-                [(center_x - w * radius), (center_y - h * radius)],
-
-                # top middle
-                [center_x, (center_y - h * radius)],
-
-                # top right
-                [(center_x + w * radius), (center_y - h * radius)],
-
-                # middle left
-                [(center_x - w * radius), center_y],
-
-                # center
-                [center_x, center_y],
-
-                # middle right
-                [(center_x + w * radius), center_y],
-
-                # bottom left
-                [(center_x - w * radius), (center_y + h * radius)],
-
-                # bottom middle
-                [center_x, (center_y + h * radius)],
-
-                # bottom right
-                [(center_x + w * radius), (center_y + h * radius)],
-            ]
+        key = (tuple(self.snapshot_state), tuple(color_detector.palette_bgr))
+        self.snapshot_layer.composite(self.frame, key, lambda image: [
+            self.draw_stickers(image, self.snapshot_state, STICKER_AREA_OFFSET, y)
+        ])
 
-            for neighbor in final_contours:
-                (x2, y2, w2, h2) = neighbor
-                for (x3, y3) in neighbor_positions:
-                    # The neighbor_positions are located in the center of each
-                    # contour instead of top-left corner.
-                    # logic: (top left < center pos) and (bottom right > center pos)
-                    if (x2 < x3 and y2 < y3) and (x2 + w2 > x3 and y2 + h2 > y3):
-                        contour_neighbors[index].append(neighbor)
-
-        # Step 3/4: Now that we know how many neighbors all contours have, we'll
-        # loop over them and find the contour that has 9 neighbors, which
-        # includes itself. This is the center piece of the cube. If we come
-        # across it, then the 'neighbors' are actually all the contours we're
-        # looking for.
-        for (contour, neighbors) in contour_neighbors.items():
-            if len(neighbors) == 9:
-                found = True
-                final_contours = neighbors
-                break
+    def scanned_successfully(self, notation=None):
+        """
+        Validate if the user scanned 9 colors for each side.
 
-        if not found:
-            return []
-
-        # Step 4/4: When we reached this part of the code we found a cube-like
-        # contour. The code below will sort all the contours on their X and Y
-        # values from the top-left to the bottom-right.
-
-        # Sort contours on the y-value first.
-        y_sorted = sorted(final_contours, key=lambda item: item[1])
-
-        # Split into 3 rows and sort each row on the x-value.
-        top_row = sorted(y_sorted[0:3], key=lambda item: item[0])
-        middle_row = sorted(y_sorted[3:6], key=lambda item: item[0])
-        bottom_row = sorted(y_sorted[6:9], key=lambda item: item[0])
-
-        sorted_contours = top_row + middle_row + bottom_row
-        return sorted_contours
-
-    def scanned_successfully(self):
-        """Validate if the user scanned 9 colors for each side."""
-        color_count = {}
-        for side, preview in self.result_state.items():
-            for bgr in preview:
-                key = str(bgr)
-                if key not in color_count:
-                    color_count[key] = 1
-                else:
-                    color_count[key] = color_count[key] + 1
-        invalid_colors = [k for k, v in color_count.items() if v != 9]
-        return len(invalid_colors) == 0
+        :param notation str: The result notation, when it's already known.
+        """
+        notation = notation or self.get_result_notation()
+        return all(notation.count(side) == 9 for side in set(notation))
 
     def draw_contours(self, contours):
         """Draw contours onto the given frame."""
@@ -228,71 +199,96 @@ class Webcam:
 
     def update_preview_state(self, contours):
         """
-        Get the average color value for the contour for every X amount of frames
+        Classify every sticker and take a majority vote over the last frames
         to prevent flickering and more precise results.
         """
-        max_average_rounds = 8
-        for index, (x, y, w, h) in enumerate(contours):
-            if index in self.average_sticker_colors and len(self.average_sticker_colors[index]) == max_average_rounds:
-                sorted_items = {}
-                for bgr in self.average_sticker_colors[index]:
-                    key = str(bgr)
-                    if key in sorted_items:
-                        sorted_items[key] += 1
-                    else:
-                        sorted_items[key] = 1
-                most_common_color = max(sorted_items, key=lambda i: sorted_items[i])
-                self.average_sticker_colors[index] = []
-                self.preview_state[index] = eval(most_common_color)
-                break
+        rois = cube_detector.get_sticker_rois(self.frame, contours)
+        dominant_colors = profiler.time('sample_colors', color_detector.get_dominant_colors, rois)
+        palette_indices = profiler.time('classify_colors', color_detector.get_palette_indices, dominant_colors)
+
+        self.preview_samples = dominant_colors
+        winners = self.sticker_filter.update(palette_indices)
+        self.preview_state = [color_detector.palette_bgr[index] for index in winners]
+        self.preview_confidences = self.sticker_filter.get_confidences()
+
+    def update_auto_capture(self):
+        """
+        Snapshot the preview once every sticker has had the same confident
+        color for long enough, unless that face is already scanned like this.
+        """
+        confident = (
+            self.sticker_filter.filled == self.sticker_filter.size and
+            self.preview_confidences.min() >= AUTO_CAPTURE_CONFIDENCE
+        )
+        if confident and self.preview_state == self.stable_preview_state:
+            self.stable_frames += 1
+        else:
+            self.stable_frames = 0
+            self.stable_preview_state = list(self.preview_state) if confident else None
+            return
+
+        if self.stable_frames < self.auto_capture_frames:
+            return
+
+        if self.preview_state == self.ignored_preview_state:
+            return
+        self.ignored_preview_state = None
+
+        center_color_name = color_detector.get_closest_color(self.preview_state[4])['color_name']
+        if self.result_state.get(center_color_name) != self.preview_state:
+            self.update_snapshot_state()
 
-            roi = self.frame[y+7:y+h-7, x+14:x+w-14]
-            avg_bgr = color_detector.get_dominant_color(roi)
-            closest_color = color_detector.get_closest_color(avg_bgr)['color_bgr']
-            self.preview_state[index] = closest_color
-            if index in self.average_sticker_colors:
-                self.average_sticker_colors[index].append(closest_color)
-            else:
-                self.average_sticker_colors[index] = [closest_color]
+    def start_next_cube(self):
+        """
+        Forget the scanned cube, so the next one can be scanned. The face that
+        is still in front of the camera isn't auto-captured again until
+        another face has been shown.
+        """
+        self.result_state = {}
+        self.result_samples = {}
+        self.sticker_filter.reset()
+        self.stable_frames = 0
+        self.stable_preview_state = None
+        self.ignored_preview_state = list(self.preview_state)
 
     def update_snapshot_state(self):
         """Update the snapshot state based on the current preview state."""
         self.snapshot_state = list(self.preview_state)
         center_color_name = color_detector.get_closest_color(self.snapshot_state[4])['color_name']
         self.result_state[center_color_name] = self.snapshot_state
-        self.draw_snapshot_stickers()
+        self.result_samples[center_color_name] = list(self.preview_samples)
+
+        # Validate the state on every snapshot, so the user knows right away
+        # which sides to scan again. Start solving as soon as all sides are
+        # scanned, so the solution is ready by the time the user quits.
+        state = self.get_result()
+        if self.solve_in_background and isinstance(state, str):
+            solver.solve_async(state)
 
     def get_font(self, size=TEXT_SIZE):
         """Load the truetype font with the specified text size."""
-        font_path = '{}/assets/arial-unicode-ms.ttf'.format(ROOT_DIR)
-        return ImageFont.truetype(font_path, size)
+        return text_renderer.get_font(size)
 
     def render_text(self, text, pos, color=(255, 255, 255), size=TEXT_SIZE, anchor='lt'):
         """
-        Render text with a shadow using the pillow module.
+        Render text with a shadow using cached sprites of the pillow module.
         """
-        font = self.get_font(size)
-
-        # Convert opencv frame (np.array) to PIL Image array.
-        frame = Image.fromarray(self.frame)
-
-        # Draw the text onto the image.
-        draw = ImageDraw.Draw(frame)
-        draw.text(pos, text, font=font, fill=color, anchor=anchor,
-                  stroke_width=1, stroke_fill=(0, 0, 0))
-
-        # Convert the pillow frame back to a numpy array.
-        self.frame = np.array(frame)
+        profiler.time('render_text', text_renderer.render, self.frame, text, pos, color, size, anchor)
 
     def get_text_size(self, text, size=TEXT_SIZE):
         """Get text size based on the default freetype2 loaded font."""
-        return self.get_font(size).getsize(text)
+        return text_renderer.get_text_size(text, size)
 
     def draw_scanned_sides(self):
         """Display how many sides are scanned by the user."""
         text = i18n.t('scannedSides', num=len(self.result_state.keys()))
         self.render_text(text, (20, self.height - 20), anchor='lb')
 
+        if self.validation_errors:
+            sides = ', '.join(i18n.t(side) for side in self.get_sides_to_rescan())
+            text = i18n.t('rescanSides', sides=sides)
+            self.render_text(text, (20, self.height - 50), anchor='lb')
+
     def draw_current_color_to_calibrate(self):
         """Display the current side's color that needs to be calibrated."""
         offset_y = 20
@@ -342,6 +338,8 @@ class Webcam:
     def reset_calibrate_mode(self):
         """Reset calibrate mode variables."""
         self.calibrated_colors = {}
+        self.calibration_samples = {}
+        self.calibration_frames_left = 0
         self.current_color_to_calibrate_index = 0
         self.done_calibrating = False
 
@@ -354,6 +352,16 @@ class Webcam:
         self.render_text(text, (self.width - offset, offset), anchor='rt')
 
     def draw_2d_cube_state(self):
+        """Draw the current result state onto the given frame."""
+        key = (
+            tuple((side, tuple(stickers)) for side, stickers in self.result_state.items()),
+            tuple(color_detector.palette_bgr)
+        )
+        self.cube_state_layer.composite(self.frame, key, lambda image: [
+            self.draw_2d_cube_state_layer(image)
+        ])
+
+    def draw_2d_cube_state_layer(self, image):
         """
         Create a 2D cube state visualization and draw the self.result_state.
 
@@ -373,6 +381,8 @@ class Webcam:
                     -----
         So we're gonna make a 4x3 grid and hardcode where each side has to go.
         Based on the x and y in that 4x3 grid we can calculate its position.
+
+        :returns: tuple of the (x1, y1, x2, y2) region that was drawn in
         """
         grid = {
             'white' : [1, 0],
@@ -418,128 +428,338 @@ class Webcam:
 
                     # shadow
                     cv2.rectangle(
-                        self.frame,
+                        image,
                         (x1, y1),
                         (x2, y2),
-                        (0, 0, 0),
+                        (0, 0, 0, 255),
                         -1
                     )
 
                     # foreground color
                     cv2.rectangle(
-                        self.frame,
+                        image,
                         (x1 + 1, y1 + 1),
                         (x2 - 1, y2 - 1),
-                        foreground_color,
+                        foreground_color + (255,),
                         -1
                     )
 
+        return (offset_x, offset_y, offset_x + (side_size + side_offset) * 4, offset_y + (side_size + side_offset) * 3)
+
     def get_result_notation(self):
         """Convert all the sides and their BGR colors to cube notation."""
-        notation = dict(self.result_state)
-        for side, preview in notation.items():
-            for sticker_index, bgr in enumerate(preview):
-                notation[side][sticker_index] = color_detector.convert_bgr_to_notation(bgr)
-
-        # Join all the sides together into one single string.
         # Order must be URFDLB (white, red, green, yellow, orange, blue)
-        combined = ''
-        for side in ['white', 'red', 'green', 'yellow', 'orange', 'blue']:
-            combined += ''.join(notation[side])
-        return combined
-
-    def state_already_solved(self):
-        """Find out if the cube hasn't been solved already."""
-        for side in ['white', 'red', 'green', 'yellow', 'orange', 'blue']:
-            # Get the center color of the current side.
-            center_bgr = self.result_state[side][4]
-
-            # Compare the center color to all neighbors. If we come across a
-            # different color, then we can assume the cube isn't solved yet.
-            for bgr in self.result_state[side]:
-                if center_bgr != bgr:
-                    return False
-        return True
+        sides = ['white', 'red', 'green', 'yellow', 'orange', 'blue']
+
+        # Classify all 54 stickers together so every color is used exactly 9
+        # times, when the raw colors of all sides are known.
+        if all(len(self.result_samples.get(side, [])) == 9 for side in sides):
+            samples = [bgr for side in sides for bgr in self.result_samples[side]]
+            colors = color_detector.assign_balanced_colors(samples, list(range(4, 54, 9)))
+            return ''.join(color_detector.notations[sides[color]] for color in colors)
 
-    def run(self):
+        # Otherwise classify all 54 stickers at once and join them together
+        # into one single string.
+        stickers = [bgr for side in sides for bgr in self.result_state[side]]
+        return ''.join(color_detector.convert_bgrs_to_notation(stickers))
+
+    def state_already_solved(self, notation=None):
         """
-        Open up the webcam and present the user with the Qbr user interface.
+        Find out if the cube hasn't been solved already.
 
-        Returns a string of the scanned state in rubik's cube notation.
+        :param notation str: The result notation, when it's already known.
+        """
+        notation = notation or self.get_result_notation()
+
+        # Every side is solved when all its stickers have the same notation.
+        return all(len(set(notation[index:index + 9])) == 1 for index in range(0, 54, 9))
+
+    def handle_key(self, key):
+        """
+        Handle a key press from the user interface.
+
+        :param key int: The key code returned by cv2.waitKey.
+        :returns: False when the user wants to quit, otherwise True
+        """
+        # Quit on escape.
+        if key == 27:
+            return False
+
+        if not self.calibrate_mode:
+            # Update the snapshot when space bar is pressed.
+            if key == 32:
+                self.update_snapshot_state()
+
+            # Switch to another language.
+            if key == ord(SWITCH_LANGUAGE_KEY):
+                next_locale = get_next_locale(config.get_setting('locale'))
+                config.set_setting('locale', next_locale)
+                i18n.set('locale', next_locale)
+                text_renderer.set_locale(next_locale)
+
+        # Toggle the profiling HUD.
+        if key == ord(PROFILER_HUD_KEY):
+            profiler.toggle_hud()
+
+        # Toggle calibrate mode.
+        if key == ord(CALIBRATE_MODE_KEY):
+            self.reset_calibrate_mode()
+            self.calibrate_mode = not self.calibrate_mode
+
+        return True
+
+    def detect(self, frame):
+        """
+        Find the contours of a cube in the given frame. This doesn't touch any
+        of the webcam state, so it is safe to call from a worker thread.
+        """
+        if self.motion_gate:
+            return self.motion_gate.detect(frame)
+        if self.tracker:
+            return self.tracker.detect(frame)
+        return cube_detector.detect(frame)
+
+    def update_state(self, key, contours):
+        """Update the preview or calibrate state based on the found contours."""
+        if len(contours) == 9:
+            self.draw_contours(contours)
+            if not self.calibrate_mode:
+                self.update_preview_state(contours)
+                if self.auto_capture_frames:
+                    self.update_auto_capture()
+            elif self.done_calibrating is False:
+                # Collect samples over the next frames once space is pressed.
+                if key == 32 and not self.calibration_frames_left:
+                    self.calibration_frames_left = CALIBRATION_FRAMES
+                if self.calibration_frames_left:
+                    self.add_calibration_samples(contours)
+
+    def add_calibration_samples(self, contours):
         """
+        Add the colors of the stickers that look like the center sticker to
+        the samples of the color that is being calibrated.
+        """
+        current_color = self.colors_to_calibrate[self.current_color_to_calibrate_index]
+        rois = cube_detector.get_sticker_rois(self.frame, contours)
+        bgrs = np.array(color_detector.get_dominant_colors(rois))
+        distances = ciede2000_batch(bgr2lab_batch(bgrs), bgr2lab_batch(bgrs[4:5]))[:, 0]
+        samples = self.calibration_samples.setdefault(current_color, [])
+        samples.extend(bgrs[distances <= CALIBRATION_MAX_DISTANCE])
+
+        self.calibration_frames_left -= 1
+        if self.calibration_frames_left:
+            return
+
+        self.calibrated_colors[current_color] = tuple(float(c) for c in np.mean(samples, axis=0))
+        self.current_color_to_calibrate_index += 1
+        self.done_calibrating = self.current_color_to_calibrate_index == len(self.colors_to_calibrate)
+        if self.done_calibrating:
+            color_models = color_detector.fit_color_models(self.calibration_samples)
+            color_detector.set_cube_color_pallete(self.calibrated_colors, color_models)
+            config.set_setting(CUBE_PALETTE, color_detector.cube_color_palette)
+            config.set_setting(COLOR_MODELS, color_detector.color_models)
+
+    def draw_interface(self):
+        """Draw the user interface onto the current frame."""
+        if self.calibrate_mode:
+            self.draw_current_color_to_calibrate()
+            self.draw_calibrated_colors()
+        else:
+            self.draw_current_language()
+            self.draw_preview_stickers()
+            self.draw_snapshot_stickers()
+            self.draw_scanned_sides()
+            self.draw_2d_cube_state()
+
+        if profiler.hud:
+            profiler.draw_hud(self.frame)
+
+    def show_frame(self):
+        """Show the current frame in the window."""
+        if not self.headless:
+            profiler.time('imshow', cv2.imshow, WINDOW_TITLE, self.frame)
+        profiler.frame_shown()
+        if self.first_frame_at is None:
+            self.first_frame_at = time.perf_counter()
+
+    def run_serial(self):
+        """Capture, detect and display every frame one after another."""
         while True:
-            _, frame = self.cam.read()
+            _, frame = profiler.time('capture', self.cam.read)
             self.frame = frame
-            key = cv2.waitKey(10) & 0xff
+            key = profiler.time('wait_key', self.read_key, 10) & 0xff
+            if self.recorder:
+                self.recorder.record_frame(frame, key)
 
-            # Quit on escape.
-            if key == 27:
+            if not self.handle_key(key):
                 break
 
-            if not self.calibrate_mode:
-                # Update the snapshot when space bar is pressed.
-                if key == 32:
-                    self.update_snapshot_state()
-
-                # Switch to another language.
-                if key == ord(SWITCH_LANGUAGE_KEY):
-                    next_locale = get_next_locale(config.get_setting('locale'))
-                    config.set_setting('locale', next_locale)
-                    i18n.set('locale', next_locale)
-
-            # Toggle calibrate mode.
-            if key == ord(CALIBRATE_MODE_KEY):
-                self.reset_calibrate_mode()
-                self.calibrate_mode = not self.calibrate_mode
-
-            grayFrame = cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY)
-            blurredFrame = cv2.blur(grayFrame, (3, 3))
-            cannyFrame = cv2.Canny(blurredFrame, 30, 60, 3)
-            kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (9, 9))
-            dilatedFrame = cv2.dilate(cannyFrame, kernel)
-
-            contours = self.find_contours(dilatedFrame)
-            if len(contours) == 9:
-                self.draw_contours(contours)
-                if not self.calibrate_mode:
-                    self.update_preview_state(contours)
-                elif key == 32 and self.done_calibrating is False:
-                    current_color = self.colors_to_calibrate[self.current_color_to_calibrate_index]
-                    (x, y, w, h) = contours[4]
-                    roi = self.frame[y+7:y+h-7, x+14:x+w-14]
-                    avg_bgr = color_detector.get_dominant_color(roi)
-                    self.calibrated_colors[current_color] = avg_bgr
-                    self.current_color_to_calibrate_index += 1
-                    self.done_calibrating = self.current_color_to_calibrate_index == len(self.colors_to_calibrate)
-                    if self.done_calibrating:
-                        color_detector.set_cube_color_pallete(self.calibrated_colors)
-                        config.set_setting(CUBE_PALETTE, color_detector.cube_color_palette)
-
-            if self.calibrate_mode:
-                self.draw_current_color_to_calibrate()
-                self.draw_calibrated_colors()
-            else:
-                self.draw_current_language()
-                self.draw_preview_stickers()
-                self.draw_snapshot_stickers()
-                self.draw_scanned_sides()
-                self.draw_2d_cube_state()
-
-            cv2.imshow("Qbr - Rubik's cube solver", self.frame)
+            contours = profiler.time('detect', self.detect, self.frame)
+            profiler.time('update_state', self.update_state, key, contours)
+            if self.recorder:
+                self.recorder.record_state(self.result_state)
+            profiler.time('draw_interface', self.draw_interface)
+
+            self.show_frame()
+
+    def capture_worker(self, frames, stats, stop):
+        """
+        Keep reading frames from the camera, only keeping the newest. Stops
+        the pipeline when the camera doesn't give any frames anymore.
+        """
+        failures = 0
+        while not stop.is_set():
+            ok, frame = profiler.time('capture', self.cam.read)
+            if not ok:
+                failures += 1
+                if failures >= PIPELINE_MAX_READ_FAILURES:
+                    stop.set()
+                time.sleep(PIPELINE_READ_RETRY_DELAY)
+                continue
+            failures = 0
+            stats.frame_captured()
+            frames.put((time.perf_counter(), frame))
+
+    def detection_worker(self, frames, detections, stop):
+        """Find the cube contours for the newest captured frame."""
+        while not stop.is_set():
+            try:
+                captured_at, frame = frames.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            detections.put((captured_at, frame, profiler.time('detect', self.detect, frame)))
+
+    def run_pipeline(self):
+        """
+        Run capture and detection on their own threads, connected by bounded
+        queues that drop the oldest frame when full, while this thread handles
+        keys, updates the state and displays the frames.
+
+        Keys are always applied on this thread to the next displayed frame, so
+        the workers never touch the webcam state.
+        """
+        frames = DropOldestQueue(PIPELINE_QUEUE_SIZE)
+        detections = DropOldestQueue(PIPELINE_QUEUE_SIZE)
+        stats = PipelineStats()
+        stop = threading.Event()
+        workers = [
+            threading.Thread(target=self.capture_worker, args=(frames, stats, stop), name='capture', daemon=True),
+            threading.Thread(target=self.detection_worker, args=(frames, detections, stop), name='detection', daemon=True),
+        ]
+        for worker in workers:
+            worker.start()
+
+        pending_key = 255
+        while True:
+            key = profiler.time('wait_key', self.read_key, 1) & 0xff
+            if key != 255:
+                pending_key = key
+
+            # Quit right away, even when there is no new frame.
+            if pending_key == 27:
+                break
+
+            try:
+                captured_at, frame, contours = detections.get(timeout=0.01)
+            except queue.Empty:
+                # The camera stopped giving frames.
+                if stop.is_set():
+                    break
+                continue
+
+            self.frame = frame
+            key, pending_key = pending_key, 255
+            if self.recorder:
+                self.recorder.record_frame(frame, key)
+            self.handle_key(key)
+            profiler.time('update_state', self.update_state, key, contours)
+            if self.recorder:
+                self.recorder.record_state(self.result_state)
+            profiler.time('draw_interface', self.draw_interface)
+
+            self.show_frame()
+            stats.frame_displayed(captured_at)
+
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+        self.pipeline_stats = stats.summary(frames.dropped + detections.dropped)
+        print('Pipeline: {captured} captured, {displayed} displayed, {dropped} dropped, '
+              'latency avg {latency_avg_ms:.1f}ms max {latency_max_ms:.1f}ms'.format(**self.pipeline_stats))
+
+    def run(self, pipeline=False, track=False, auto_capture=0, motion_gate=False):
+        """
+        Open up the webcam and present the user with the Qbr user interface.
+
+        :param pipeline bool: Capture and detect frames on separate threads.
+        :param track bool: Track the cube in between frames instead of
+                           detecting it in the whole frame every time.
+        :param auto_capture int: Snapshot a face automatically once it has
+                                 been stable for this amount of frames, 0 to
+                                 only snapshot on the space bar.
+        :param motion_gate bool: Reuse the last contours while nothing in
+                                 the frame moves.
+        Returns a string of the scanned state in rubik's cube notation.
+        """
+        self.auto_capture_frames = auto_capture
+        if track:
+            self.tracker = CubeTracker(cube_detector)
+        if motion_gate:
+            self.motion_gate = MotionGate(self.tracker or cube_detector)
+
+        if pipeline:
+            self.run_pipeline()
+        else:
+            self.run_serial()
 
         self.cam.release()
-        cv2.destroyAllWindows()
+        if not self.headless:
+            cv2.destroyAllWindows()
+
+        if self.tracker:
+            print('Tracking: {} tracked, {} redetected ({:.0%} tracked)'.format(
+                self.tracker.tracked,
+                self.tracker.redetected,
+                self.tracker.get_tracked_ratio()
+            ))
+        if self.motion_gate:
+            print('Motion gate: {} skipped, {} detected ({:.0%} skipped)'.format(
+                self.motion_gate.skipped,
+                self.motion_gate.detected,
+                self.motion_gate.get_skipped_ratio()
+            ))
+
+        return self.get_result()
+
+    def get_result(self):
+        """
+        Get the scanned state in rubik's cube notation.
 
+        :returns: str, or an error code when the state isn't complete or
+                  already solved
+        """
+        self.validation_errors = []
         if len(self.result_state.keys()) != 6:
             return E_INCORRECTLY_SCANNED
 
-        if not self.scanned_successfully():
+        notation = self.get_result_notation()
+        if not self.scanned_successfully(notation):
             return E_INCORRECTLY_SCANNED
 
-        if self.state_already_solved():
+        if self.state_already_solved(notation):
             return E_ALREADY_SOLVED
 
-        return self.get_result_notation()
+        self.validation_errors = validate(notation)
+        if self.validation_errors:
+            return E_INCORRECTLY_SCANNED
+
+        return notation
+
+    def get_sides_to_rescan(self):
+        """Get the color names of the sides that have to be scanned again."""
+        sides = {notation: side for side, notation in color_detector.notations.items()}
+        return [sides[face] for face in get_faces_to_rescan(self.validation_errors)]
 
 
-webcam = Webcam()
+webcam = Lazy(Webcam)